@@ -38,6 +38,10 @@ class PostAdmin(admin.ModelAdmin):
 	date_hierarchy = 'date_created'
 	filter_vertical = 'tags',
 	list_filter = 'feed',
+
+	def save_model(self, request, obj, form, change):
+		if 'content' in form.changed_data: obj.content_process()
+		super(PostAdmin, self).save_model(request, obj, form, change)
 admin.site.register(models.Post, PostAdmin)
 
 
@@ -50,8 +54,15 @@ admin.site.register(models.Subscriber, SubscriberAdmin)
 
 class FilterBaseAdmin(admin.ModelAdmin):
 	list_display = 'name', 'handler_name',\
-		'crossref', 'crossref_span', 'handler_description'
+		'crossref', 'crossref_span', 'handler_description',\
+		'stats_calls', 'stats_pass_rate', 'stats_time_avg', 'stats_queries'
 	ordering = 'name',
+	exclude = 'stats_calls', 'stats_passed', 'stats_time', 'stats_queries'
+	actions = 'stats_reset',
+
+	def stats_reset(self, request, queryset):
+		queryset.update(stats_calls=0, stats_passed=0, stats_time=0, stats_queries=0)
+	stats_reset.short_description = 'Reset handler call stats'
 admin.site.register(models.FilterBase, FilterBaseAdmin)
 
 
@@ -60,4 +71,11 @@ class FilterAdmin(admin.ModelAdmin):
 admin.site.register(models.Filter, FilterAdmin)
 
 
+class CrossrefRebuildAdmin(admin.ModelAdmin):
+	list_display = '__unicode__', 'rebuild_order', 'date_threshold',\
+		'date_created', 'date_started', 'posts_done', 'posts_total'
+	filter_horizontal = 'feeds',
+admin.site.register(models.CrossrefRebuild, CrossrefRebuildAdmin)
+
+
 admin.site.register(models.Link)
@@ -35,6 +35,9 @@ if __name__ == '__main__':
 		help='Socket timeout (in seconds) for connections (default: %(default)s).')
 	parser.add_option('-d', '--delay', type='int', default=0,
 		help='Delay between fetching the feeds (default: none).')
+	parser.add_option('-w', '--cache-warm', type='int', default=0,
+		help='Number of concurrent requests to pre-render pages of updated'
+			' sites into cache with (FEEDJACK_CACHE_WARM_URLS), 0 to disable (default: %default).')
 
 	parser.add_option('-q', '--quiet', action='store_true',
 		help='Report only severe errors, no info or warnings.')
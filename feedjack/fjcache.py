@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 
 from hashlib import md5
+from time import time
+from threading import local
 from django.core.cache import cache, get_cache
 from django.conf import settings
 
@@ -15,9 +17,19 @@ except AttributeError:
 else: ajax_cache = get_cache(ajax_cache)
 
 
-T_HOST = 1
 T_ITEM = 2
-T_META = 3
+T_GEN = 3
+T_STALE = 4
+T_LOCK = 5
+T_FRAGMENT = 6
+
+# How long last copy of an invalidated/expired item can be served
+#  while it's being regenerated, and for how long regeneration lock is held at most.
+stale_duration = getattr(settings, 'FEEDJACK_CACHE_STALE_DURATION', 24*60*60)
+lock_timeout = getattr(settings, 'FEEDJACK_CACHE_LOCK_TIMEOUT', 60)
+# Fragment keys should include everything these are rendered from, so there's no
+#  invalidation for them and duration only limits how long unused ones are kept.
+fragment_duration = getattr(settings, 'FEEDJACK_CACHE_FRAGMENT_DURATION', 7*24*60*60)
 
 
 def str2md5(key):
@@ -27,47 +39,124 @@ def str2md5(key):
 def getkey(stype, site_id=None, key=None):
 	'Returns the cache key depending on its type.'
 	base = '%s.feedjack' % (settings.CACHE_MIDDLEWARE_KEY_PREFIX)
-	if stype == T_HOST:
-		return '%s.hostcache' % base
-	elif stype == T_ITEM:
+	if stype == T_ITEM:
 		return '%s.%d.item.%s' % (base, site_id, str2md5(key))
-	elif stype == T_META:
-		return '%s.%d.meta' % (base, site_id)
+	elif stype == T_GEN:
+		return '%s.%s.gen' % (base, key)
+	elif stype == T_STALE:
+		return '%s.%d.stale.%s' % (base, site_id, str2md5(key))
+	elif stype == T_LOCK:
+		return '%s.%d.lock.%s' % (base, site_id, str2md5(key))
+	elif stype == T_FRAGMENT:
+		return '%s.fragment.%s' % (base, str2md5(key))
+
+
+# Cached items are grouped into namespaces, each with its own
+#  generation counter, all of which are embedded into item keys.
+# Invalidation of a namespace is just an increment of its counter,
+#  leaving old entries to expire (or be evicted) on their own.
+# Every item belongs to its site namespace (site-wide changes) and any number of:
+#  "posts" - any post changes on a site, "feed" and "tag" - changes to posts of a
+#  specific feed or with specific tag (on any site).
+
+def ns_site(site_id): return 'site.%d' % site_id
+def ns_posts(site_id): return 'posts.%d' % site_id
+def ns_feed(feed_id): return 'feed.%d' % int(feed_id)
+def ns_tag(name): return 'tag.%s' % str2md5(name)
+
+def page_namespaces(site_id, feed=None, tag=None, **criterias):
+	'Namespaces for a page (or syndication feed) with specified criterias.'
+	if feed: return [ns_feed(feed)] # tag pages for feed are covered as well
+	elif tag: return [ns_tag(tag)]
+	else: return [ns_posts(site_id)]
+
+def generations(namespaces):
+	'Returns a list of generation counters for namespaces, initializing missing ones.'
+	keys = list(getkey(T_GEN, key=ns) for ns in namespaces)
+	gens = cache.get_many(keys)
+	for gkey in set(keys).difference(gens):
+		# Time-based value is unlikely to match counter, evicted before
+		gen = int(time() * 1000)
+		gens[gkey] = gen if cache.add(gkey, gen, 365*24*60*60) else cache.get(gkey, gen)
+	return list(gens[gkey] for gkey in keys)
+
+def generation_bump(namespace):
+	'''Invalidates all cached items in a namespace.
+		Counter is also advanced to the current time (in ms),
+			so that it can be used as a modification time of items.'''
+	gkey, ts = getkey(T_GEN, key=namespace), int(time() * 1000)
+	try: gen = cache.incr(gkey)
+	except ValueError: return # missing counter will be re-initialized anyway
+	if gen < ts: cache.set(gkey, ts, 365*24*60*60)
+
+def sites_version():
+	'Returns a counter, incremented on any changes to sites.'
+	return generations(['sites'])[0]
 
+def sites_version_bump(): generation_bump('sites')
 
-def hostcache_get():
-	'Retrieves the hostcache dictionary'
-	return cache.get(getkey(T_HOST))
+def cache_invalidate(namespaces):
+	'Invalidates all cached items in any of the namespaces.'
+	for ns in set(namespaces): generation_bump(ns)
 
-def hostcache_set(value):
-	'Sets the hostcache dictionary'
-	cache.set(getkey(T_HOST), value)
 
-def cache_get(site_id, key):
-	'Retrieves cache data from a site.'
-	return cache.get(getkey(T_ITEM, site_id, key))
+# Item keys from cache_get misses are remembered to be used in cache_set,
+#  so that it won't need to fetch generations again and won't store data,
+#  rendered before namespace invalidation, as a fresh entry.
+_itemkeys = local()
 
-def cache_set(site, key, data):
+def _itemkey(site_id, key, namespaces):
+	namespaces = [ns_site(site_id)] + list(namespaces)
+	return getkey( T_ITEM, site_id, u'%s--%s' % (key,
+		'.'.join('%d' % gen for gen in generations(namespaces))) )
+
+def cache_get(site_id, key, namespaces=tuple()):
+	'''Retrieves cache data from a site.
+		Data stored with any "namespaces" should be requested with same ones.'''
+	tkey = _itemkey(site_id, key, namespaces)
+	data = cache.get(tkey)
+	if data is None:
+		try: tkeys = _itemkeys.keys
+		except AttributeError: tkeys = _itemkeys.keys = dict()
+		if len(tkeys) > 100: tkeys.clear() # misses, never followed by cache_set
+		tkeys[site_id, key, tuple(namespaces)] = tkey
+	return data
+
+def cache_set(site, key, data, namespaces=tuple(), unlock=False):
 	'''Sets cache data for a site.
-		All keys related to a site are stored in a meta key. This key is per-site.'''
-	tkey = getkey(T_ITEM, site.id, key)
-	mkey = getkey(T_META, site.id)
-	tmp = cache.get(mkey)
-	longdur = 365*24*60*60
-	if not tmp:
-		tmp = [tkey]
-		cache.set(mkey, [tkey], longdur)
-	elif tkey not in tmp:
-		tmp.append(tkey)
-		cache.set(mkey, tmp, longdur)
+		Data is invalidated along with the site or any of the specified namespaces.
+		"unlock" should only be passed by the holder of the regeneration lock (see cache_lock).'''
+	try: tkey = _itemkeys.keys.pop((site.id, key, tuple(namespaces)))
+	except (AttributeError, KeyError): tkey = _itemkey(site.id, key, namespaces)
 	cache.set(tkey, data, site.cache_duration)
+	cache.set( getkey(T_STALE, site.id, key),
+		data, max(stale_duration, site.cache_duration) )
+	if unlock: cache_unlock(site.id, key)
+
+def cache_get_stale(site_id, key):
+	'''Retrieves last stored copy of cache data from a site,
+		regardless of any invalidation since then (but not older than stale_duration).'''
+	return cache.get(getkey(T_STALE, site_id, key))
+
+def cache_lock(site_id, key):
+	'''Acquires a lock to regenerate cache data, returning False if it's already
+		taken. Lock is released by cache_set (with unlock=True) or cache_unlock,
+			or expires on its own.'''
+	return cache.add(getkey(T_LOCK, site_id, key), True, lock_timeout)
+
+def cache_unlock(site_id, key):
+	cache.delete(getkey(T_LOCK, site_id, key))
+
+def fragments_get(keys):
+	'''Returns a dict of cached site-independent fragments (e.g. rendered posts)
+		for any of the keys, fetched in one go.'''
+	tkeys = dict((getkey(T_FRAGMENT, key=key), key) for key in keys)
+	return dict( (tkeys[tkey], data) for tkey, data
+		in cache.get_many(tkeys.keys()).iteritems() )
+
+def fragment_set(key, data):
+	cache.set(getkey(T_FRAGMENT, key=key), data, fragment_duration)
 
 def cache_delsite(site_id):
 	'Removes all cache data from a site.'
-	mkey = getkey(T_META, site_id)
-	tmp = cache.get(mkey)
-	if not tmp:
-		return
-	for tkey in tmp:
-		cache.delete(tkey)
-	cache.delete(mkey)
+	generation_bump(ns_site(site_id))
@@ -1,8 +1,14 @@
 # -*- coding: utf-8 -*-
 
 import math
+from bisect import bisect_left
+from heapq import nlargest
+from datetime import datetime, timedelta
+import operator as op
 
-from feedjack import fjlib, fjcache
+from django.db.models import Count
+
+from feedjack import models, fjcache
 
 def getsteps(levels, tagmax):
 	""" Returns a list with the max number of posts per "tagcloud level"
@@ -24,16 +30,14 @@ def build(site, tagdata):
 	tagdata.sort()
 
 	# we get the most popular tag to calculate the tags' weigth
-	tagmax = 0
-	for tagname, tagcount in tagdata:
-		if tagcount > tagmax:
-			tagmax = tagcount
+	tagmax = max(tagcount for tagname, tagcount in tagdata) if tagdata else 0
 	steps = getsteps(site.tagcloud_levels, tagmax)
+	# weight is the first level, tagcount fits into (boundaries are non-decreasing)
+	bounds = list(step[1] for step in steps)
 
 	tags = []
 	for tagname, tagcount in tagdata:
-		weight = [twt[0] \
-			for twt in steps if twt[1] >= tagcount and twt[1] > 0][0]+1
+		weight = steps[bisect_left(bounds, tagcount)][0]+1
 		tags.append({'tagname':tagname, 'count':tagcount, 'weight':weight})
 	return tags
 
@@ -41,16 +45,17 @@ def cloudata(site):
 	""" Returns a dictionary with all the tag clouds related to a site.
 	"""
 
-	tagdata = fjlib.getquery("""
-		SELECT feedjack_post.feed_id, feedjack_tag.name, COUNT(*)
-		FROM feedjack_post, feedjack_subscriber, feedjack_tag,
-		feedjack_post_tags
-		WHERE feedjack_post.feed_id=feedjack_subscriber.feed_id AND
-		feedjack_post_tags.tag_id=feedjack_tag.id AND
-		feedjack_post_tags.post_id=feedjack_post.id AND
-		feedjack_subscriber.site_id=%d
-		GROUP BY feedjack_post.feed_id, feedjack_tag.name
-		ORDER BY feedjack_post.feed_id, feedjack_tag.name""" % site.id)
+	if site.tagcloud_days:
+		# Only recent posts are counted, using index on date_created
+		tagdata = models.Post.tags.through.objects.filter(
+				post__feed__subscriber__site=site,
+				post__date_created__gt=datetime.now() - timedelta(site.tagcloud_days) )\
+			.values_list('post__feed', 'tag__name').annotate(Count('id'))
+	else:
+		# Counters are maintained on post tags' changes (see models.TagCount)
+		tagdata = models.TagCount.objects\
+			.filter(feed__subscriber__site=site, count__gt=0)\
+			.values_list('feed', 'tag__name', 'count')
 	tagdict = {}
 	globaldict = {}
 	cloudict = {}
@@ -64,6 +69,7 @@ def cloudata(site):
 			globaldict[tagname] = tagcount
 	tagdict[0] = globaldict.items()
 	for key, val in tagdict.items():
+		if site.tagcloud_size: val = nlargest(site.tagcloud_size, val, key=op.itemgetter(1))
 		cloudict[key] = build(site, val)
 	return cloudict
 
@@ -71,10 +77,11 @@ def getcloud(site, feed_id=None):
 	""" Returns the tag cloud for a site or a site's subscriber.
 	"""
 
-	cloudict = fjcache.cache_get(site.id, 'tagclouds')
+	cache_ns = [fjcache.ns_posts(site.id)]
+	cloudict = fjcache.cache_get(site.id, 'tagclouds', cache_ns)
 	if not cloudict:
 		cloudict = cloudata(site)
-		fjcache.cache_set(site, 'tagclouds', cloudict)
+		fjcache.cache_set(site, 'tagclouds', cloudict, cache_ns)
 
 	# A subscriber's tag cloud has been requested.
 	if feed_id:
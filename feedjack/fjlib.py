@@ -7,10 +7,12 @@ from django.core.exceptions import ObjectDoesNotExist
 from django.core.paginator import Paginator, InvalidPage
 from django.http import Http404
 from django.utils.encoding import smart_unicode, force_unicode
+from django.utils.html import strip_tags, escape
 
 from feedjack import models, fjcache
 
 import itertools as it, operator as op, functools as ft
+from collections import defaultdict
 from datetime import datetime, timedelta
 from urllib import quote
 
@@ -18,7 +20,7 @@ from urllib import quote
 try:
 	from lxml.html import fromstring as lxml_fromstring, tostring as lxml_tostring
 	from lxml.html.clean import Cleaner as lxml_Cleaner
-	from lxml.etree import XMLSyntaxError as lxml_SyntaxError
+	from lxml.etree import XMLSyntaxError as lxml_SyntaxError, ParserError as lxml_ParserError
 
 except ImportError:
 	# at least strip c0 control codes, which are quite common in broken html
@@ -36,14 +38,29 @@ except ImportError:
 		import lxml
 		raise NotImplementedError('Looks like some of lxml imports has failed')
 	lxml_tostring = lxml_soup = lxml_fail
+	html_errors = ValueError,
+
+	def html_thumbnail(string, *argz, **kwz): return ''
+
+	def html_text(string, length=None):
+		string = strip_tags(html_cleaner(string))
+		return string if not length else html_text_truncate(string, length)
 
 else:
+	# Errors that html processing functions can still raise on some weird content
+	html_errors = ValueError, lxml_SyntaxError, lxml_ParserError
+
 	def lxml_soup(string):
 		'Safe processing of any tag soup (which is a norm on the internets).'
-		try: doc = lxml_fromstring(force_unicode(string))
+		string = force_unicode(string)
+		try: doc = lxml_fromstring(string)
 		except lxml_SyntaxError: # last resort for "tag soup"
 			from lxml.html.soupparser import fromstring as soup
-			doc = soup(force_unicode(string))
+			doc = soup(string)
+		except lxml_ParserError: # "Document is empty" for whitespace/comment-only content
+			doc = lxml_fromstring(u'<div></div>')
+		except ValueError: # e.g. encoding declaration in unicode string
+			doc = lxml_fromstring(u'<div>{0}</div>'.format(escape(string)))
 		return doc
 
 	def html_cleaner(string):
@@ -52,6 +69,31 @@ else:
 		lxml_Cleaner(style=True)(doc)
 		return lxml_tostring(doc)
 
+	def html_thumbnail( string,
+			xpaths=["//img[not(@alt='thumbnail')]", '//img'], attrs=dict(align='center') ):
+		'''First element, matching any of the xpaths (or whole document, if none),
+			with attrs added to it, as html. Used to represent post in grid-like layouts.'''
+		doc = lxml_soup(string)
+		for xpath in xpaths:
+			match = doc.xpath(xpath)
+			if match:
+				doc = match[0]
+				break
+		doc.attrib.update(attrs)
+		return lxml_tostring(doc, with_tail=False)
+
+	def html_text(string, length=None):
+		'Plain text from html, truncated to approximately "length" chars, if specified.'
+		string = lxml_soup(string).text_content()
+		return string if not length else html_text_truncate(string, length)
+
+
+def html_text_truncate(string, length):
+	'Truncate text on the word boundary (if possible) before "length" chars, adding an ellipsis.'
+	string = u' '.join(force_unicode(string).split())
+	if len(string) <= length: return string
+	return string[:length].rsplit(None, 1)[0] + u'...'
+
 
 def getquery(query):
 	'Performs a query and get the results.'
@@ -69,52 +111,84 @@ def get_extra_content(site, ctx):
 	# get the subscribers' feeds
 	feeds = site.active_feeds
 	ctx['feeds'] = feeds.order_by('name')
-	# get the last_modified/checked time
-	mod, chk = op.itemgetter('modified', 'checked')(feeds.timestamps)
+	# get the last_modified/checked time, stored on site by feedjack_update
+	mod, chk = site.feeds_modified, site.feeds_checked
+	if chk is None: mod, chk = op.itemgetter('modified', 'checked')(feeds.timestamps)
 	chk = chk or datetime(1970, 1, 1)
 	ctx['last_modified'], ctx['last_checked'] = mod or chk, chk
 	ctx['site'] = site
 	ctx['media_url'] = '{0}feedjack/{1}'.format(settings.MEDIA_URL, site.template)
 
 
+def posts_prefetch(posts, site=None, subscribers=None):
+	'''Batch-load data for a list of posts (e.g. a page), with one query for each kind:
+			"qtags" - list of tags (use it instead of "tags" in templates),
+			"subscriber" - Subscriber object, if site (or a list of subscribers) is passed.
+		Feeds are expected to be loaded with the posts (select_related).'''
+	tagd = defaultdict(list)
+	if posts:
+		for rel in models.Post.tags.through.objects\
+				.filter(post__in=list(post.id for post in posts))\
+				.select_related('tag').order_by('tag__name'):
+			tagd[rel.post_id].append(rel.tag)
+	if subscribers is None and site is not None:
+		subscribers = models.Subscriber.objects.filter( site=site,
+			feed__in=set(post.feed_id for post in posts) ).select_related('feed')
+	subd = dict((sub.feed_id, sub) for sub in subscribers)\
+		if subscribers is not None else None
+	for post in posts:
+		post.qtags = tagd[post.id]
+		if subd is not None: post.subscriber = subd.get(post.feed_id)
+	return posts
+
+
 def get_posts_tags(subscribers, object_list, feed, tag_name):
 	'''Adds a qtags property in every post object in a page.
 		Use "qtags" instead of "tags" in templates to avoid unnecesary DB hits.'''
 
-	tagd = dict()
 	user_obj = None
 	tag_obj = None
-	tags = models.Tag.objects.extra(
-		select=dict(post_id='{0}.{1}'.format(
-			*it.imap( connection.ops.quote_name,
-				('feedjack_post_tags', 'post_id') ) )),
-		tables=['feedjack_post_tags'],
-		where=[
-		'{0}.{1}={2}.{3}'.format(*it.imap( connection.ops.quote_name,
-			('feedjack_tag', 'id', 'feedjack_post_tags', 'tag_id') )),
-		'{0}.{1} IN ({2})'.format(
-			connection.ops.quote_name('feedjack_post_tags'),
-			connection.ops.quote_name('post_id'),
-			', '.join([str(post.id) for post in object_list]) ) ] )
-
-	for tag in tags:
-		if tag.post_id not in tagd: tagd[tag.post_id] = list()
-		tagd[tag.post_id].append(tag)
-		if tag_name and tag.name == tag_name: tag_obj = tag
-
-	subd = dict()
-	for sub in subscribers: subd[sub.feed.id] = sub
+	posts_prefetch(object_list, subscribers=subscribers)
 	for post in object_list:
-		if post.id in tagd: post.qtags = tagd[post.id]
-		else: post.qtags = list()
-		post.subscriber = subd[post.feed.id]
+		if tag_name and not tag_obj:
+			for tag in post.qtags:
+				if tag.name == tag_name:
+					tag_obj = tag
+					break
 		if feed == post.feed: user_obj = post.subscriber
 
 	return user_obj, tag_obj
 
 
-def get_page(site, page=1, **criterias):
-	'Returns a paginator object and a requested page from it.'
+# Keyset pagination: pages are selected relative to a post on a previous/next
+#  one (?after=<post_id> / ?before=<post_id>), instead of ?page=<number>,
+#  so deep pages don't make db scan all the preceding posts.
+# Total number of posts/pages (count query) is only provided with page_keyset_count.
+page_keyset = getattr(settings, 'FEEDJACK_PAGE_KEYSET', False)
+page_keyset_count = getattr(settings, 'FEEDJACK_PAGE_KEYSET_COUNT', False)
+
+class KeysetPage(object):
+	'Page of posts, selected relative to some other post, mimicking django Page interface.'
+
+	class paginator(object): num_pages = count = None
+
+	def __init__(self, object_list, has_next, has_previous, count=None, per_page=None):
+		self.object_list, self._has_next, self._has_previous =\
+			object_list, has_next, has_previous
+		self.number = None
+		if count is not None:
+			self.paginator = self.paginator()
+			self.paginator.count = count
+			self.paginator.num_pages = max(1, (count - 1) // per_page + 1)
+
+	def has_next(self): return self._has_next
+	def has_previous(self): return self._has_previous
+
+
+def get_page(site, page=1, after=None, before=None, **criterias):
+	'''Returns a paginator object and a requested page from it.
+		Either page number or "after"/"before" post id (with
+			page_keyset enabled) can be used to specify the page.'''
 
 	if 'since' in criterias:
 		since = criterias['since']
@@ -133,7 +207,25 @@ def get_page(site, page=1, **criterias):
 	order_force = criterias.pop('asc', None)
 
 	posts = models.Post.objects.filtered(site, **criterias)\
-		.sorted(site.order_posts_by, force=order_force).select_related()
+		.sorted( site.order_posts_by, force=order_force,
+			timeline=models.site_timeline ).select_related()
+
+	if page_keyset and (after or before or page == 1):
+		per_page, cursor = site.posts_per_page, after or before
+		count = posts.count() if page_keyset_count else None
+		if cursor:
+			try: cursor = models.Post.objects.get(id=cursor)
+			except (ValueError, ObjectDoesNotExist): raise Http404
+			posts = posts.seek( site.order_posts_by,
+				cursor, force=order_force, backwards=bool(before) )
+			if before: posts = posts.reverse()
+		posts = list(posts[:per_page + 1])
+		more = len(posts) > per_page
+		posts = posts[:per_page]
+		if before:
+			posts.reverse()
+			return KeysetPage(posts, True, more, count, per_page)
+		return KeysetPage(posts, more, bool(cursor), count, per_page)
 
 	paginator = Paginator(posts, site.posts_per_page)
 	try: return paginator.page(page)
@@ -144,13 +236,15 @@ def page_context(request, site, **criterias):
 	'Returns the context dictionary for a page view.'
 	try: page = int(request.GET.get('page', 1))
 	except ValueError: page = 1
+	cursors = dict( (k, request.GET[k])
+		for k in ['after', 'before'] if request.GET.get(k) )
 
 	feed, tag = criterias.get('feed'), criterias.get('tag')
 	if feed:
 		try: feed = models.Feed.objects.get(id=feed)
 		except ObjectDoesNotExist: raise Http404
 
-	page = get_page(site, page=page, **criterias)
+	page = get_page(site, page=page, **dict(criterias, **cursors))
 	subscribers = site.active_subscribers
 
 	if site.show_tagcloud and page.object_list:
@@ -169,15 +263,20 @@ def page_context(request, site, **criterias):
 				.get(site=site, feed=feed) if feed else None
 		except ObjectDoesNotExist: raise Http404
 
+	keyset = isinstance(page, KeysetPage)
 	ctx = dict(
 		object_list = page.object_list,
-		is_paginated = page.paginator.num_pages > 1,
+		is_paginated = page.has_next() or page.has_previous(),
 		results_per_page = site.posts_per_page,
 		has_next = page.has_next(),
 		has_previous = page.has_previous(),
 		page = page.number,
-		next = page.number + 1,
-		previous = page.number - 1,
+		next = page.number + 1 if not keyset else None,
+		previous = page.number - 1 if not keyset else None,
+		next_query = '?page={0}'.format(page.number + 1) if not keyset else\
+			('?after={0}'.format(page.object_list[-1].id) if page.object_list else ''),
+		previous_query = '?page={0}'.format(page.number - 1) if not keyset else\
+			('?before={0}'.format(page.object_list[0].id) if page.object_list else ''),
 		pages = page.paginator.num_pages,
 		hits = page.paginator.count,
 		last_modified = max(it.imap(
@@ -200,3 +299,43 @@ def page_context(request, site, **criterias):
 	ctx['user'] = user_obj
 
 	return ctx
+
+
+_render_handler = None
+
+def render_page(host, path, scheme='http'):
+	'''Renders page for an absolute path on a host through the usual
+			request handling (middleware, urls, views), without any network io.
+		Unlike django.test.client.Client, WSGIHandler is safe to use from
+			multiple threads and doesn't keep any rendered templates' context around.
+		Returns status code, dict of (lowercase) headers and content.'''
+	global _render_handler
+	from django.core.handlers.wsgi import WSGIHandler
+	from urllib import unquote
+	from cStringIO import StringIO
+	import sys
+	if _render_handler is None: _render_handler = WSGIHandler()
+
+	path, query = path.split('?', 1) if '?' in path else (path, '')
+	server, port = host.rsplit(':', 1) if ':' in host else\
+		(host, '443' if scheme == 'https' else '80')
+	environ = {
+		'REQUEST_METHOD': 'GET', 'SCRIPT_NAME': '',
+		'PATH_INFO': unquote(path), 'QUERY_STRING': query,
+		'HTTP_HOST': host, 'SERVER_NAME': server, 'SERVER_PORT': port,
+		'SERVER_PROTOCOL': 'HTTP/1.1', 'REMOTE_ADDR': '127.0.0.1',
+		'wsgi.version': (1, 0), 'wsgi.url_scheme': scheme,
+		'wsgi.input': StringIO(), 'wsgi.errors': sys.stderr,
+		'wsgi.multithread': True, 'wsgi.multiprocess': True, 'wsgi.run_once': False }
+	if scheme == 'https': environ['HTTPS'] = 'on'
+
+	status = list()
+	def start_response(status_line, headers, exc_info=None):
+		status[:] = int(status_line.split(None, 1)[0]), dict(
+			(k.lower(), v) for k, v in headers )
+	response = _render_handler(environ, start_response)
+	# Streamed responses are only cached when consumed, close() releases locks, db connection
+	try: content = ''.join(response)
+	finally:
+		if hasattr(response, 'close'): response.close()
+	return status[0], status[1], content
@@ -43,11 +43,13 @@ class FeedValidationError(Exception): pass
 
 import itertools as it, operator as op, functools as ft
 from datetime import datetime
-from time import sleep
+from time import sleep, time
 from collections import defaultdict
+from urlparse import urlparse
 import os, sys
 
 import feedparser
+from django.conf import settings
 from feedjack.models import transaction_wrapper, transaction, IntegrityError
 
 import codecs
@@ -62,6 +64,12 @@ log.extra = ft.partial(log.log, logging.EXTRA)
 # TODO: special formatter to insert feed_id to the prefix
 
 
+# Paths (relative to site url) to pre-render into cache after update, either
+#  a list for all sites or a dict of such lists, keyed by site id (None - default).
+CACHE_WARM_URLS = getattr( settings, 'FEEDJACK_CACHE_WARM_URLS',
+    ['/', '/syndication/atom/', '/syndication/rss/'] )
+
+
 #mtime = lambda ttime: datetime(*ttime[:6])
 def mtime(ttime):
     try:
@@ -84,6 +92,9 @@ class FeedProcessor(object):
     def __init__(self, feed, options):
         self.feed, self.options = feed, options
         self.fpf = None
+        # Collected to invalidate only the cached pages, affected by changes
+        self.changed_posts, self.changed_tags = list(), set()
+        self.changed_meta = False
 
     def _get_guid(self, fp_entry):
         return fp_entry.get('id', '') or fp_entry.get('title', '') or fp_entry.get('link', '')
@@ -151,11 +162,15 @@ class FeedProcessor(object):
                 # Update fields
                 for field in post_base_fields + ['content', 'comments']:
                     setattr(post_old, field, getattr(post, field))
+                post_old.content_process()
                 post_old.date_modified = post.date_modified or post_old.date_modified
                 # Update tags
+                tags_old = set(post_old.tags.values_list('name', flat=True))
                 post_old.tags.clear()
                 for tcat in fcat: post_old.tags.add(tcat)
                 post_old.save()
+                self.changed_posts.append(post_old.id)
+                self.changed_tags.update(tags_old)
             else:
                 retval = ENTRY_SAME
                 log.extra( ( '[{0}] Post has not changed: {1}' if not changed else
@@ -172,6 +187,7 @@ class FeedProcessor(object):
                 elif self.fpf.get('modified'): post.date_modified = mtime(self.fpf.modified)
             if not post.date_modified: post.date_modified = datetime.now()
             if self.options.hidden: post.hidden = True
+            post.content_process()
             try: post.save()
             except IntegrityError:
                 log.error( 'IntegrityError while saving (supposedly) new'\
@@ -179,6 +195,7 @@ class FeedProcessor(object):
                 raise
             for tcat in fcat: post.tags.add(tcat)
             self.postdict[post.guid] = post
+            self.changed_posts.append(post.id)
 
         return retval
 
@@ -243,9 +260,11 @@ class FeedProcessor(object):
                 log.info( '[{0}] Skipped feed error: {1} ({2})'\
                     .format(self.feed.id, self.feed.feed_url, bozo) )
 
+        meta = self.feed.title, self.feed.tagline, self.feed.link
         self.feed.title = self.fpf.feed.get('title', '')[0:254]
         self.feed.tagline = self.fpf.feed.get('tagline', '')
         self.feed.link = self.fpf.feed.get('link', '')
+        self.changed_meta = meta != (self.feed.title, self.feed.tagline, self.feed.link)
         self.feed.last_checked = datetime.now()
 
         log.debug('[{0}] Feed info for: {1}\n{2}'.format(
@@ -290,6 +309,47 @@ class FeedProcessor(object):
 
 
 
+def cache_warm_urls(site):
+    'Returns a list of (host, path) tuples to pre-render for a site.'
+    paths = CACHE_WARM_URLS if not isinstance(CACHE_WARM_URLS, dict)\
+        else CACHE_WARM_URLS.get(site.id, CACHE_WARM_URLS.get(None, list()))
+    site_url = urlparse(site.url)
+    if not site_url.netloc:
+        log.warn('Unable to warm cache for site with relative url: {0}'.format(site.url))
+        return list()
+    prefix = site_url.path.rstrip('/')
+    return list((site_url.netloc, prefix + path) for path in paths)
+
+def _cache_warm_url((host, path)):
+    from feedjack.fjlib import render_page
+    from django.db import connection
+    time_start = time()
+    try: status, headers, content = render_page(host, path)
+    except:
+        log.exception('Failed to render page for cache: http://{0}{1}'.format(host, path))
+        status = None
+    finally: connection.close() # thread-local, won't be reused
+    time_start = time() - time_start
+    if status != 200:
+        log.warn( 'Unexpected response status ({0}) for'
+            ' page: http://{1}{2}'.format(status, host, path) )
+    log.debug('Cached page: http://{0}{1} ({2:.2f}s)'.format(host, path, time_start))
+    return status == 200
+
+def cache_warm(site_ids, threads=1):
+    '''Pre-render pages (CACHE_WARM_URLS) of the specified sites through
+        usual views, which store them in cache, using up to "threads" concurrent requests.
+        Returns number of successfully rendered pages.'''
+    from feedjack.models import Site
+    urls = list(it.chain.from_iterable( cache_warm_urls(site)
+        for site in Site.objects.filter(id__in=site_ids, use_internal_cache=True) ))
+    if not urls or not threads: return 0
+    from multiprocessing.pool import ThreadPool
+    pool = ThreadPool(min(threads, len(urls)))
+    try: return sum(pool.map(_cache_warm_url, urls))
+    finally: pool.terminate()
+
+
 @transaction_wrapper(logging)
 def bulk_update(optz):
     import socket
@@ -297,14 +357,11 @@ def bulk_update(optz):
 
 
     from feedjack.models import Feed, Site
-    affected_sites = set() # to drop cache
 
     if optz.feed:
         feeds = list(Feed.objects.filter(pk__in=optz.feed)) # no is_active check
         for feed_id in set(optz.feed).difference(it.imap(op.attrgetter('id'), feeds)):
             log.warn('Unknown feed id: {0}'.format(feed_id))
-        affected_sites.update(Site.objects.filter(
-            subscriber__feed__in=feeds ).values_list('id', flat=True))
 
     if optz.site:
         feeds = Feed.objects.filter( is_active=True,
@@ -312,11 +369,9 @@ def bulk_update(optz):
         sites = Site.objects.filter(pk__in=optz.site).values_list('id', flat=True)
         for site_id in set(optz.site).difference(sites):
             log.warn('Unknown site id: {0}'.format(site_id))
-        affected_sites.update(sites)
 
     if not optz.feed and not optz.site: # fetches even unbound feeds
         feeds = Feed.objects.filter(is_active=True)
-        affected_sites = Site.objects.all().values_list('id', flat=True)
 
 
     feeds, time_delta_global = list(feeds), datetime.now()
@@ -324,10 +379,16 @@ def bulk_update(optz):
         .format(time_delta_global, len(feeds)) )
 
     feed_stats, entry_stats = defaultdict(int), defaultdict(int)
+    changed_posts, changed_tags, changed_meta = list(), set(), set()
     for feed in feeds:
         time_delta = datetime.now()
-        ret_feed, ret_entries = FeedProcessor(feed, optz).process()
+        processor = FeedProcessor(feed, optz)
+        ret_feed, ret_entries = processor.process()
         time_delta = datetime.now() - time_delta
+        if ret_feed == FEED_OK:
+            changed_posts.extend(processor.changed_posts)
+            changed_tags.update(processor.changed_tags)
+            if processor.changed_meta: changed_meta.add(feed.id)
 
         log.info('[{0}] Processed {1} in {2}s [{3}] [{4}]{5}'.format(
             feed.id, feed.feed_url, time_delta, feed_keys_dict[ret_feed],
@@ -346,10 +407,43 @@ def bulk_update(optz):
         ' '.join('{0}={1}'.format(label, entry_stats[key]) for key,label in entry_keys),
         ' '.join('{0}={1}'.format(label, feed_stats[key]) for key,label in feed_keys) ))
 
-    # Removing the cached data in all sites,
-    #  this will only work with the memcached, db and file backends
-    # TODO: make it work by "magic" through model signals
-    from feedjack import fjcache
-    for site_id in affected_sites: fjcache.cache_delsite(site_id)
+    # Filtering results rebuilds, deferred from admin changes to feeds' filters
+    from feedjack.models import CrossrefRebuild
+    jobs = CrossrefRebuild.objects.process_pending()
+    if jobs: log.info('* Processed pending crossref rebuild jobs: {0}'.format(jobs))
 
+    # Timestamps of sites' feeds, displayed on every page
+    Site.feeds_timestamps_update(Site.objects.filter(
+        subscriber__feed__in=list(feed.id for feed in feeds) ).values_list('id', flat=True))
+
+    transaction.commit()
+
+    # Filters for new posts are only evaluated on commit (see transaction_bulk_process),
+    #  so stats are flushed (and committed separately) after it.
+    from feedjack.models import FilterBase
+    filters_stats = FilterBase.stats_flush()
     transaction.commit()
+    bases = FilterBase.objects.in_bulk(filters_stats.keys())
+    for base_id, stats in sorted( filters_stats.iteritems(),
+            key=lambda (base_id, stats): stats['time'], reverse=True ):
+        log.info('* FILTER: {0}, calls={1[calls]} passed={1[passed]} time={1[time]:.3f}s queries={1[queries]}'\
+            .format(bases[base_id].name if base_id in bases else base_id, stats))
+
+    # Invalidate cached pages of the updated feeds, their posts' tags
+    #  and sites' non-specific pages (front pages, syndication feeds, tag clouds) only.
+    # Feed metadata (e.g. title) changes are displayed on every page of a site.
+    # Done after commit, so that re-cached pages won't have stale data.
+    from feedjack import fjcache
+    from feedjack.models import Post
+    fjcache.sites_version_bump() # for updated timestamps
+    affected_sites = set(Post.cache_invalidate(changed_posts, changed_tags))
+    for site_id in Site.objects.filter(subscriber__feed__in=changed_meta)\
+        .values_list('id', flat=True).distinct():
+        fjcache.cache_delsite(site_id)
+        affected_sites.add(site_id)
+
+    if affected_sites and optz.cache_warm:
+        time_delta = datetime.now()
+        pages = cache_warm(affected_sites, threads=optz.cache_warm)
+        log.info('* Pre-rendered pages for cache: {0} (sites: {1}, delta: {2}s)'\
+            .format(pages, len(affected_sites), datetime.now() - time_delta))
@@ -0,0 +1,134 @@
+'''
+management command to pre-render sites into static (and pre-compressed) files
+
+@author: chrisv <me@cv.gd>
+'''
+
+from optparse import make_option
+from urlparse import urlparse
+from urllib import quote, unquote
+from gzip import GzipFile
+from cStringIO import StringIO
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+
+from feedjack.models import Site, TagCount
+from feedjack.fjlib import render_page
+
+try: import brotli
+except ImportError: brotli = None
+
+import logging
+log = logging.getLogger('feedjack_export')
+
+
+def site_paths(site, tags=True):
+    'Returns a list of paths (relative to site url) to export for a site.'
+    paths = ['/', '/syndication/atom/', '/syndication/rss/',
+        '/syndication/opml/', '/syndication/foaf/']
+    specs = list( 'feed/{0}/'.format(feed_id) for feed_id
+        in site.active_feeds.values_list('id', flat=True) )
+    if tags:
+        specs.extend( 'tag/{0}/'.format(quote(name.encode('utf-8'), safe=''))
+            for name in TagCount.objects.filter( count__gt=0,
+                    feed__subscriber__site=site, feed__subscriber__is_active=True )\
+                .values_list('tag__name', flat=True).distinct()
+            if '/' not in name and not name.startswith('.') )
+    for spec in specs:
+        paths.extend('{0}{1}'.format(prefix, spec) for prefix in
+            ['/', '/syndication/atom/', '/syndication/rss/'])
+    return paths
+
+def file_update(path, content):
+    'Atomically replaces file with new content. Returns False if it was the same.'
+    try:
+        with open(path, 'rb') as src:
+            if src.read() == content: return False
+    except (OSError, IOError): pass
+    tmp = '{0}.tmp.{1}'.format(path, os.getpid())
+    try:
+        with open(tmp, 'wb') as dst: dst.write(content)
+        os.rename(tmp, path)
+    finally:
+        if os.path.exists(tmp): os.unlink(tmp)
+    return True
+
+def export_page(dest, host, path):
+    '''Renders page through usual views and stores it (along with .gz and .br
+        versions) as "index.html" or "index.xml" (depending on content type) in
+        a dir, corresponding to the path. Returns None if page can't be rendered.'''
+    status, headers, content = render_page(host, path)
+    if status != 200:
+        log.warn( 'Unexpected response status ({0}) for'
+            ' page: http://{1}{2}'.format(status, host, path) )
+        return None
+    name = 'index.html' if headers.get('content-type', '').startswith('text/html') else 'index.xml'
+    path = os.path.join(dest, host, *filter(None, map(path_segment, path.split('/'))))
+    if not os.path.isdir(path): os.makedirs(path)
+    path = os.path.join(path, name)
+    if not file_update(path, content)\
+            and all(os.path.exists(path + ext) for ext in encoders): return False
+    for ext, encode in encoders.iteritems(): file_update(path + ext, encode(content))
+    return True
+
+def path_segment(segment):
+    segment = unquote(segment)
+    if segment in ('.', '..'): raise ValueError('Invalid path segment: {0!r}'.format(segment))
+    return segment
+
+def _gzip(content):
+    buff = StringIO()
+    dst = GzipFile(mode='wb', compresslevel=9, fileobj=buff, mtime=0)
+    dst.write(content)
+    dst.close()
+    return buff.getvalue()
+
+encoders = {'.gz': _gzip}
+if brotli: encoders['.br'] = brotli.compress
+
+
+class Command(BaseCommand):
+    help = "pre-renders sites' pages and syndication feeds into static files"\
+        " (only first pages of listings, further ones should be served by django)"
+
+    option_list = BaseCommand.option_list + (
+        make_option('-d', '--dest',
+                    help='Directory to store files in, with subdirectory for each site host.'),
+        make_option('-s', '--site', action='append', type='int',
+                    help='A site id (or several of them) to export (default: all).'),
+        make_option('--no-tags', action='store_true',
+                    help='Do not export pages and syndication feeds for tags.'),
+        make_option('-q', '--quiet', action='store_true',
+                    help='Report only severe errors, no info or warnings.'),
+        make_option('--debug', action='store_true', help='Even more verbose output.')
+    )
+
+    def handle(self, **options):
+        if options.get('debug'): logging.basicConfig(level=logging.DEBUG)
+        elif options.get('quiet'): logging.basicConfig(level=logging.WARNING)
+        else: logging.basicConfig(level=logging.INFO)
+
+        if not options.get('dest'): raise CommandError('--dest directory must be specified')
+
+        sites = Site.objects.all()
+        if options.get('site'): sites = sites.filter(id__in=options['site'])
+        for site in sites:
+            site_url = urlparse(site.url)
+            if not site_url.netloc:
+                log.warn('Unable to export site with relative url: {0}'.format(site.url))
+                continue
+            prefix, updated, failed = site_url.path.rstrip('/'), 0, 0
+            paths = site_paths(site, tags=not options.get('no_tags'))
+            for path in paths:
+                path = prefix + path
+                try: result = export_page(options['dest'], site_url.netloc, path)
+                except Exception:
+                    log.exception('Failed to export page: http://{0}{1}'.format(site_url.netloc, path))
+                    result = None
+                if result is None: failed += 1
+                elif result:
+                    updated += 1
+                    log.debug('Updated page: http://{0}{1}'.format(site_url.netloc, path))
+            log.info('Site {0}: {1} pages, updated: {2}, failed: {3}'.format(
+                site.url, len(paths), updated, failed ))
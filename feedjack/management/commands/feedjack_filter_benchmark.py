@@ -0,0 +1,76 @@
+'''
+management command to benchmark filters on recent posts (no results are stored)
+
+@author: chrisv <me@cv.gd>
+'''
+
+from optparse import make_option
+from datetime import datetime, timedelta
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from feedjack.models import Filter, Post,\
+    FILTER_CR_TIMELINE_MAP, filter_handler_timed
+
+class Command(BaseCommand):
+    args = '<filter_id filter_id ...>'
+    help = "replays filters over last N posts, reporting their run time, pass rate and db queries"
+
+    option_list = BaseCommand.option_list + (
+        make_option('-n', '--posts', type='int', default=1000,
+                    help='Number of last posts to run filter on (default: %default).'),
+        make_option('-f', '--feed', action='append', type='int',
+                    help='Only use posts of specified feed(s) (default: posts of feeds'
+                        ' the filter is used on). Can be specified multiple times.'),
+        make_option('--span', action='append', type='int',
+                    help='Estimate rebuild time for specified crossref_span (in days)'
+                        ' value(s) as well as for the one of filter base, if any.'),
+    )
+
+    def handle(self, *args, **options):
+        if not args: raise CommandError('At least one filter id should be specified')
+        for filter_id in args:
+            try: filter_obj = Filter.objects.select_related('base').get(id=int(filter_id))
+            except (ValueError, Filter.DoesNotExist):
+                raise CommandError('Unknown filter id: {0}'.format(filter_id))
+            self.benchmark(filter_obj, options)
+
+    def benchmark(self, filter_obj, options):
+        base = filter_obj.base
+        posts = Post.objects.filter(feed__in=options['feed'])\
+            if options['feed'] else Post.objects.filter(feed__filters=filter_obj)
+        order = 'date_{0}'.format(FILTER_CR_TIMELINE_MAP[base.crossref_timeline])
+        bench = list(posts.select_related('feed').order_by('-{0}'.format(order))[:options['posts']])
+        bench.reverse() # same order as rebuild walks posts in
+
+        run_times, passed, queries = list(), 0, 0
+        for post in bench:
+            result, run_time, post_queries = filter_handler_timed(filter_obj, post)
+            run_times.append(run_time)
+            passed += bool(result)
+            queries += post_queries
+
+        write = lambda line='': sys.stdout.write('{0}\n'.format(line))
+        write('Filter #{0}: {1}'.format(filter_obj.id, filter_obj.shortname))
+        if not run_times:
+            write('  no posts to benchmark on')
+            return write()
+        run_times.sort()
+        time_avg = sum(run_times) / len(run_times)
+        write('  posts: {0}, passed: {1} ({2:.1f}%)'.format(
+            len(bench), passed, passed * 100.0 / len(bench) ))
+        write('  time: total={0:.3f}s avg={1:.4f}s median={2:.4f}s max={3:.4f}s'.format(
+            sum(run_times), time_avg, run_times[len(run_times) // 2], run_times[-1] ))
+        write('  db queries: total={0} avg={1:.1f}'.format(queries, queries * 1.0 / len(bench)))
+
+        spans = list(options['span'] or list())
+        if base.crossref_span: spans.append(base.crossref_span)
+        for span in sorted(set(spans)):
+            span_posts = posts.filter(**{ '{0}__gt'.format(order):
+                datetime.now() - timedelta(span) }).count()
+            write(( '  crossref_span={0} days{1}: {2} posts,'
+                    ' estimated rebuild time: {3:.1f}s' ).format(
+                span, ' (current)' if span == base.crossref_span else '',
+                span_posts, span_posts * time_avg ))
+        write()
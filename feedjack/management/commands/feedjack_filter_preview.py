@@ -0,0 +1,66 @@
+'''
+management command to preview effect of a filters' changes on recent posts of a feed
+
+@author: chrisv <me@cv.gd>
+'''
+
+from optparse import make_option
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from feedjack.models import Feed, Filter, FilterBase, FEED_FILTERING_LOGIC
+
+class Command(BaseCommand):
+    args = '<feed_id>'
+    help = "checks recent feed posts against proposed set of filters, without storing any results"
+
+    option_list = BaseCommand.option_list + (
+        make_option('-f', '--filter', action='append',
+                    help='Filter to check posts against, either id of existing one,'
+                        ' or "base_name" / "base_name:parameter" spec of a new one.'
+                        ' Can be specified multiple times (default: current feed filters).'),
+        make_option('--no-filters', action='store_true',
+                    help='Check posts against empty set of filters.'),
+        make_option('-l', '--logic', choices=FEED_FILTERING_LOGIC._fields,
+                    help='Filters composition logic, one of: {0} (default: current one).'\
+                        .format(', '.join(FEED_FILTERING_LOGIC._fields))),
+        make_option('-n', '--posts', type='int', default=100,
+                    help='Number of last posts to check (default: %default).'),
+        make_option('-a', '--all', action='store_true',
+                    help='List all checked posts, not just the ones with changed results.'),
+    )
+
+    def get_filter(self, spec):
+        try: return Filter.objects.select_related('base').get(id=int(spec))
+        except ValueError: pass
+        except Filter.DoesNotExist: raise CommandError('Unknown filter id: {0}'.format(spec))
+        base, parameter = spec.split(':', 1) if ':' in spec else (spec, None)
+        try: base = FilterBase.objects.get(name=base)
+        except FilterBase.DoesNotExist: raise CommandError('Unknown filter base: {0}'.format(base))
+        return Filter(base=base, parameter=parameter)
+
+    def handle(self, *args, **options):
+        if len(args) != 1: raise CommandError('Exactly one feed id should be specified')
+        try: feed = Feed.objects.get(id=int(args[0]))
+        except (ValueError, Feed.DoesNotExist):
+            raise CommandError('Unknown feed id: {0}'.format(args[0]))
+
+        filters = map(self.get_filter, options['filter'])\
+            if options['filter'] else (list() if options['no_filters'] else None)
+        logic = getattr(FEED_FILTERING_LOGIC, options['logic'])\
+            if options['logic'] else None
+        preview = feed.filters_preview(filters, logic, limit=options['posts'])
+
+        write = lambda line='': sys.stdout.write(u'{0}\n'.format(line).encode('utf-8'))
+        changed = 0
+        for post, result_old, result_new in preview.results:
+            if result_old != result_new: changed += 1
+            elif not options['all']: continue
+            write(u'{0} {1} {2}'.format(
+                ' ' if result_old == result_new else ('+' if result_new else '-'),
+                post.title, post.link ))
+        passed = lambda idx: sum(1 for result in preview.results if result[idx])
+        write(( 'Posts checked: {0}, shown before: {1},'
+                ' after: {2}, changed: {3}, time: {4:.3f}s' ).format(
+            len(preview.results), passed(1), passed(2), changed, preview.time ))
@@ -0,0 +1,83 @@
+'''
+management command to process pending (deferred) filtering results rebuilds
+
+@author: chrisv <me@cv.gd>
+'''
+
+from optparse import make_option
+from time import sleep
+
+from django.core.management.base import BaseCommand, CommandError
+
+from feedjack.models import CrossrefRebuild, SitePost, TagCount, Post
+
+import logging
+log = logging.getLogger('feedjack_rebuild')
+
+class Command(BaseCommand):
+    help = "processes pending crossref filtering results rebuild jobs"
+
+    option_list = BaseCommand.option_list + (
+        make_option('-c', '--chunk', type='int', default=200,
+                    help='Number of posts to process between job progress'
+                        ' checkpoints/reports (default: %default).'),
+        make_option('--reset', action='store_true',
+                    help='Drop all stored filtering results and schedule full rebuild for all'
+                        ' feeds with filters, e.g. after switching FEEDJACK_FILTERING_BITMAP setting.'),
+        make_option('--timeline', action='store_true',
+                    help='Re-create all site listing (SitePost) entries,'
+                        ' e.g. after enabling FEEDJACK_SITE_TIMELINE setting.'),
+        make_option('--tag-counts', action='store_true',
+                    help='Re-calculate all per-feed tag counters (TagCount), used for tag clouds.'),
+        make_option('--content', action='store_true',
+                    help='Process content (clean html, thumbnail, excerpt)'
+                        ' of all posts that were fetched before it was stored.'),
+        make_option('-i', '--interval', type='int', default=0,
+                    help='Keep running, checking for new jobs with'
+                        ' specified interval (in seconds, default: process pending jobs and exit).'),
+        make_option('-q', '--quiet', action='store_true',
+                    help='Report only severe errors, no info or warnings.'),
+        make_option('--debug', action='store_true', help='Even more verbose output.')
+    )
+
+    def handle(self, **options):
+        if options.get('debug'): logging.basicConfig(level=logging.DEBUG)
+        elif options.get('quiet'): logging.basicConfig(level=logging.WARNING)
+        else: logging.basicConfig(level=logging.INFO)
+
+        if options['chunk'] <= 0: raise CommandError('--chunk should be a positive number')
+
+        def progress(job):
+            log.info('Job #{0}: {1}/{2} posts processed'.format(
+                job.id, job.posts_done, job.posts_total ))
+
+        if options.get('timeline'):
+            SitePost.objects.rebuild()
+            log.info('Rebuilt site listings: {0} entries'.format(SitePost.objects.count()))
+
+        if options.get('tag_counts'):
+            TagCount.objects.rebuild()
+            log.info('Rebuilt tag counters: {0}'.format(TagCount.objects.count()))
+
+        if options.get('content'):
+            done = 0
+            while True:
+                # update() is used to keep date_updated and avoid triggering any save hooks
+                posts = list(Post.objects.filter(content_clean__isnull=True)[:options['chunk']])
+                if not posts: break
+                for post in posts:
+                    post.content_process()
+                    Post.objects.filter(id=post.id).update( content_clean=post.content_clean,
+                        content_thumb=post.content_thumb, content_text=post.content_text )
+                done += len(posts)
+                log.info('Processed content of {0} posts'.format(done))
+
+        if options.get('reset'):
+            log.info('Scheduled reset jobs: {0}'.format(len(CrossrefRebuild.objects.schedule_reset())))
+
+        while True:
+            jobs = CrossrefRebuild.objects.process_pending(
+                chunk=options['chunk'], progress=progress )
+            if jobs: log.info('Processed rebuild jobs: {0}'.format(jobs))
+            if not options['interval']: break
+            sleep(options['interval'])
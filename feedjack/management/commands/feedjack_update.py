@@ -35,6 +35,9 @@ class Command(BaseCommand):
                     help='Socket timeout (in seconds) for connections (default: %(default)s).'),
         make_option('-d', '--delay', type='int', default=0,
                     help='Delay between fetching the feeds (default: none).'),
+        make_option('-w', '--cache-warm', type='int', default=0,
+                    help='Number of concurrent requests to pre-render pages of updated'
+                        ' sites into cache with (FEEDJACK_CACHE_WARM_URLS), 0 to disable (default: %default).'),
         make_option('-q', '--quiet', action='store_true',
                     help='Report only severe errors, no info or warnings.'),
         #make_option('-v', '--verbose', action='store_true', help='Verbose output.'),
@@ -51,6 +54,7 @@ class Command(BaseCommand):
                 self.max_diff = options['max_diff']
                 self.force = options['force']
                 self.hidden = options['hidden']
+                self.cache_warm = options['cache_warm']
         
         if options.get('debug'): logging.basicConfig(level=logging.DEBUG)
         #elif options.get('verbose'): logging.basicConfig(level=logging.EXTRA)
@@ -1,16 +1,18 @@
 # -*- coding: utf-8 -*-
 
 from django.core.exceptions import ObjectDoesNotExist, ValidationError
-from django.db.models import signals, Avg, Max, Min, Count
+from django.db.models import signals, Avg, Max, Min, Count, F, Q
 from django.db import models, connection
 from django.utils.translation import ugettext_lazy as _
 from django.utils.encoding import smart_unicode
+from django.conf import settings
 
 from feedjack import fjcache
 
 import itertools as it, operator as op, functools as ft
 from collections import namedtuple, defaultdict, Iterable, Iterator
 from datetime import datetime, timedelta
+from time import time
 import logging
 
 
@@ -55,8 +57,16 @@ class Site(models.Model):
 				_('Day the post was first obtained (for nicer per-feed grouping).')) ),
 		default=SITE_ORDERING.modified )
 	tagcloud_levels = models.PositiveIntegerField(_('tagcloud level'), default=5)
+	tagcloud_size = models.PositiveIntegerField(_('tagcloud size'), default=0,
+		help_text=_('Max number of (most used) tags in a tagcloud, 0 - no limit.') )
+	tagcloud_days = models.PositiveIntegerField(_('tagcloud days'), default=0,
+		help_text=_('Only count tags of posts, obtained in this number of last days, 0 - all posts.') )
 	show_tagcloud = models.BooleanField(_('show tagcloud'), default=True)
 
+	# Max timestamps of active feeds, updated by feedjack_update (and on subscription changes)
+	feeds_modified = models.DateTimeField(_('feeds last modified'), null=True, editable=False)
+	feeds_checked = models.DateTimeField(_('feeds last checked'), null=True, editable=False)
+
 	use_internal_cache = models.BooleanField(_('use internal cache'), default=True)
 	cache_duration = models.PositiveIntegerField(_('cache duration'), default=60*60*24,
 		help_text=_('Duration in seconds of the cached pages and data.') )
@@ -98,8 +108,30 @@ class Site(models.Model):
 					tdef.default_site = False
 					tdef.save()
 		self.url = self.url.rstrip('/')
-		fjcache.hostcache_set({})
 		super(Site, self).save()
+		fjcache.sites_version_bump()
+		fjcache.cache_delsite(self.id)
+
+	@staticmethod
+	def _delete_handler(sender, instance, **kwz): fjcache.sites_version_bump()
+
+	@staticmethod
+	def feeds_timestamps_update(site_ids):
+		'''Update stored timestamps of sites' active feeds with a single aggregate query.
+			Doesn't bump sites' version, so in-process copies
+				of Site objects (see views.site_resolve) might not see the change.'''
+		site_ids = set(site_ids)
+		if not site_ids: return
+		stamps = dict( (row['site'], row) for row in Subscriber.objects\
+			.filter(site__in=site_ids, is_active=True, feed__last_checked__isnull=False)\
+			.order_by().values('site').annotate(
+				modified=Max('feed__last_modified'), checked=Max('feed__last_checked') ) )
+		for site_id in site_ids:
+			row = stamps.get(site_id, dict())
+			Site.objects.filter(id=site_id).update(
+				feeds_modified=row.get('modified'), feeds_checked=row.get('checked') )
+
+signals.post_delete.connect(Site._delete_handler, sender=Site)
 
 
 
@@ -146,6 +178,15 @@ class FilterBase(models.Model):
 			'changes to keep this results conclusive. Performance-quality knob, since'
 			' ideally this should be an infinity (indicated by NULL value).' )
 
+	# Cumulative handler call stats, see filters_stats_add
+	stats_calls = models.PositiveIntegerField('Calls', default=0)
+	stats_passed = models.PositiveIntegerField('Passed', default=0)
+	stats_time = models.FloatField('Run time', default=0,
+		help_text='Total handler run time, seconds.' )
+	stats_queries = models.PositiveIntegerField('DB queries', default=0,
+		help_text='Total number of db queries made by handler. Only counted'
+			' with DEBUG enabled or on django versions with "use_debug_cursor" option.' )
+
 	@property
 	def handler(self):
 		'Handler function'
@@ -164,6 +205,28 @@ class FilterBase(models.Model):
 		except ImportError: doc = '<Failed to import handler>'
 		return smart_unicode(doc or '')
 
+	@property
+	def stats_pass_rate(self):
+		return '{0:.1f}%'.format(op.truediv(self.stats_passed, self.stats_calls) * 100)\
+			if self.stats_calls else '-'
+
+	@property
+	def stats_time_avg(self):
+		return '{0:.4f}s'.format(self.stats_time / self.stats_calls)\
+			if self.stats_calls else '-'
+
+	@staticmethod
+	def stats_flush():
+		'''Add stats, accumulated in filters_stats, to db counters.
+			Returns these stats (as {base_id: stats}), resetting in-process ones.'''
+		stats = dict(filters_stats)
+		filters_stats.clear()
+		for base_id, base_stats in stats.iteritems():
+			FilterBase.objects.filter(id=base_id).update(**dict(
+				('stats_{0}'.format(k), F('stats_{0}'.format(k)) + v)
+				for k,v in base_stats.iteritems() ))
+		return stats
+
 	def __unicode__(self): return u'{0.name} ({0.handler_name})'.format(self)
 
 
@@ -204,6 +267,71 @@ class FilterResult(models.Model):
 			u' {0.post.feed.shortname}, {0.timestamp})'.format(self)
 
 
+# Alternative storage for filtering results - as Post.filtering_mask (which
+#  results are known) and Post.filtering_bits (which of these have passed) bitfields,
+#  with N-th bit corresponding to N-th filter (by id) of post feed (see Feed.filters_slots).
+# Takes no extra rows and allows to invalidate results for any number of posts with
+#  one UPDATE statement. Switching storage mode doesn't convert existing results,
+#  see "feedjack_rebuild --reset" command.
+filtering_results_bitmap = getattr(settings, 'FEEDJACK_FILTERING_BITMAP', False)
+FILTERING_BITMAP_SLOTS = 62 # fits into signed bigint
+
+
+
+# Non-crossref filters' results for a batch of posts can be calculated in
+#  a pool of worker processes (see Post.filtering_results_precompute).
+# Handlers are looked up by name there, as they might not be picklable.
+filters_processes = getattr(settings, 'FEEDJACK_FILTERS_PROCESSES', None)
+
+def _filters_pool(pool=list()):
+	if not pool:
+		from multiprocessing import Pool
+		# Forked workers should not share db connection (socket) with the parent.
+		# It can't be closed inside a transaction though, so in that case
+		#  workers just drop the inherited one, opening their own when needed.
+		if not transaction.is_managed(): connection.close()
+		pool.append(Pool(filters_processes, _filters_pool_init))
+	return pool[0]
+
+def _filters_pool_init(inherited=list()):
+	# Inherited connection object is kept referenced, as closing it
+	#  (incl. on garbage collection) would terminate parent's db session.
+	inherited.append(connection.connection)
+	connection.connection = None
+
+def _filter_handler_call(args):
+	base_name, handler_name, parameter, post = args
+	return filter_handler_timed(Filter( parameter=parameter,
+		base=FilterBase(name=base_name, handler_name=handler_name) ), post)
+
+
+# Per-FilterBase handler call stats, accumulated in-process
+#  and added to db counters by FilterBase.stats_flush.
+filters_stats = defaultdict(ft.partial(defaultdict, int))
+
+def filters_stats_add(base_id, result, run_time, queries=0):
+	stats = filters_stats[base_id]
+	stats['calls'] += 1
+	stats['passed'] += bool(result)
+	stats['time'] += run_time
+	stats['queries'] += queries
+
+def filter_handler_timed(filter_obj, post):
+	'''Call filter handler for a post, returning tuple of
+		its result, run time and a number of db queries it made.'''
+	debug_cursor = getattr(connection, 'use_debug_cursor', None)
+	connection.use_debug_cursor, queries = True, len(connection.queries)
+	try:
+		run_time = time()
+		result = filter_obj.handler(post)
+		run_time = time() - run_time
+	finally:
+		connection.use_debug_cursor = debug_cursor
+		queries, query_log = len(connection.queries) - queries, connection.queries
+		if not settings.DEBUG: del query_log[len(query_log) - queries:]
+	return result, run_time, queries
+
+
 
 FEED_FILTERING_LOGIC = namedtuple('FilterLogic', 'all any')(*xrange(2))
 
@@ -211,8 +339,8 @@ FEED_FILTERING_LOGIC = namedtuple('FilterLogic', 'all any')(*xrange(2))
 class FeedQuerySet(models.query.QuerySet):
 	@property
 	def timestamps(self):
-		return dict(it.izip( ('modified', 'checked'), self.filter(last_checked__isnull=False)\
-			.aggregate(Max('last_modified'), Max('last_checked')).itervalues() ))
+		return self.filter(last_checked__isnull=False)\
+			.aggregate(modified=Max('last_modified'), checked=Max('last_checked'))
 
 class Feeds(models.Manager):
 	def get_query_set(self): return FeedQuerySet(self.model)
@@ -257,6 +385,10 @@ class Feed(models.Model):
 		return u'{0} ({1})'.format( self.name, self.feed_url
 			if len(self.feed_url) <= 50 else '{0}...'.format(self.feed_url[:47]) )
 
+	def filters_slots(self):
+		'List of feed filters, where index is the bit number in filtering bitmaps.'
+		return list(self.filters.select_related('base').order_by('id'))
+
 
 	@staticmethod
 	def _filters_update_handler_check(sender, instance, **kwz):
@@ -302,6 +434,12 @@ class Feed(models.Model):
 					raise ValidationError( 'Crossref filters ordering and update condition'
 						' should match for all cross-referenced feeds. Not matching: {0}'.format(k) )
 				else: aggregate[k] = v
+			if filtering_results_bitmap and action == 'pre_add':
+				added = 1 if reverse else len(pk_set)
+				for feed in related_feeds:
+					if feed.filters.count() + added > FILTERING_BITMAP_SLOTS:
+						raise ValidationError( 'Only up to {0} filters per feed'
+							' are supported with filtering bitmaps'.format(FILTERING_BITMAP_SLOTS) )
 			return # validaton success
 		## Since these are forced to be the same for all feeds...
 		## Note, that they are same just because it's convenient. Otherwise, filtering
@@ -321,17 +459,17 @@ class Feed(models.Model):
 		## Only valid for m2m_update and post_save hook (when "created is False").
 		## That certainly affects every Post of "instance", so they all should be updated.
 		## Shouldn't happen too often, hopefully.
+		## Actual rebuild is done by CrossrefRebuild job, which can be deferred.
 		if m2m_update or (created is False and instance._filters_logic_update):
-			Feed._filters_update_handler_lock = True # this _is_ recursive!
-			tainted = Post.objects.filter(feed__in=related_feeds)
-			if rebuild_spec:
-				FilterResult.objects.filter(
-					post__feed__in=related_feeds, filter__base__crossref=True ).delete()
-				tainted = tainted.order_by(rebuild_order) # doesn't matter otherwise
-			for post in tainted: post.filtering_result_update()
-			Feed._filters_update_handler_lock = False
+			# Filters' bits will be shifted after m2m update, hence invalid
+			if m2m_update and filtering_results_bitmap:
+				Post.objects.filter(feed__in=related_feeds)\
+					.update(filtering_mask=0, filtering_bits=0)
+			CrossrefRebuild.objects.schedule( related_feeds,
+				rebuild_order if rebuild_spec else None ) # doesn't matter otherwise
 		else: # build/update results for directly-affected posts, won't rebuild crossref results
 			Feed._filters_update_handler_lock = True
+			Post.filtering_results_precompute(affected_posts)
 			for post in affected_posts: post.filtering_result_update()
 			Feed._filters_update_handler_lock = False
 		# Shortcut in case there are no affected feeds with crossref filters
@@ -358,24 +496,11 @@ class Feed(models.Model):
 				#  as well as other feeds' results within the same timespan.
 				date_threshold = max( date_threshold,
 					min(it.imap(op.attrgetter(rebuild_order), affected_posts)) )
-		# Set anti-recursion lock.
-		Feed._filters_update_handler_lock = True
-		# This actually drops all the results before "date_threshold" on "related_feeds".
-		# Note that local update-date is checked, not the remote "date_modified" field.
-		related_feeds = set(related_feeds) # so it won't generate repeated queries
-		tainted = FilterResult.objects.filter(post__feed__in=related_feeds, filter__base__crossref=True)
-		if date_threshold:
-			tainted = tainted.filter(**{ 'post__{0}__gt'\
-				.format(rebuild_order): date_threshold })
-		tainted.delete()
-		## Now, walk the posts, checking/updating results for each one.
-		# Posts are be updated in the "last-touched" order, for consistency of cross-ref filters' results.
-		# Amount of work here is quite extensive, since this (ideally) should affect every Post.
-		tainted = Post.objects.filter(feed__in=related_feeds)
-		if date_threshold: tainted = tainted.filter(**{'{0}__gt'.format(rebuild_order): date_threshold})
-		for post in tainted.order_by(rebuild_order): post.filtering_result_update()
-		## Unlock this function again.
-		Feed._filters_update_handler_lock = False
+		## Drop all the results after "date_threshold" on "related_feeds" and walk the posts,
+		##  checking/updating results for each one - that's what the job does.
+		## Amount of work there is quite extensive, since this (ideally) should affect every Post.
+		CrossrefRebuild.objects.schedule(
+			set(related_feeds), rebuild_order, date_threshold )
 
 	# Anti-recursion flag, class-global
 	_filters_update_handler_lock = False
@@ -389,7 +514,57 @@ class Feed(models.Model):
 		if Feed._filters_update_handler_lock: return
 		return Feed._filters_update_handler(Feed, feeds, force=True)
 
+
+	def filters_preview(self, filters=None, filters_logic=None, limit=100):
+		'''Check last "limit" posts of the feed against specified set of filters
+				(can be unsaved Filter objects) and composition logic (current
+				feed ones by default), without storing any results.
+			Filters are evaluated in the same "lazy" fashion as the actual ones,
+				and crossref filters will see current (stored) results of other posts.
+			Returns FiltersPreview tuple of (post, current_result, new_result)
+				tuples, in the order posts were checked, and time it took.'''
+		if filters is None: filters = self.filters.select_related('base')
+		filters = sorted(filters, key=op.attrgetter('base.crossref'))
+		by_or = ( self.filters_logic if filters_logic is None
+			else filters_logic ) == FEED_FILTERING_LOGIC.any
+		rebuild_order = [ 'date_{0}'.format(FILTER_CR_TIMELINE_MAP[filter_obj.base.crossref_timeline])
+			for filter_obj in filters if filter_obj.base.crossref ] or ['date_created']
+		posts = list(self.posts.order_by('-{0}'.format(rebuild_order[0]))[:limit])
+		posts.reverse() # same order as rebuild walks posts in
+
+		results, time_total = list(), time()
+		for post in posts:
+			result = not by_or # none passed / none failed
+			for filter_obj in filters:
+				if bool(filter_handler_timed(filter_obj, post)[0]) == by_or:
+					result = by_or
+					break
+			# NULL means that there never were any filters for the feed
+			results.append((post, post.filtering_result is not False, result))
+		return FiltersPreview(results, time() - time_total)
+
+	@staticmethod
+	def _filters_delete_handler_check(sender, instance, **kwz):
+		# Feed-Filter relations are removed on Filter/FilterBase delete without m2m_changed signals
+		instance._filters_delete_feeds = set( Feed.objects.filter(filters__base=instance)
+			if isinstance(instance, FilterBase) else instance.feeds.all() )
+
+	@staticmethod
+	def _filters_delete_handler(sender, instance, **kwz):
+		feeds = getattr(instance, '_filters_delete_feeds', None)
+		if not feeds: return
+		# Remaining filters' bits get shifted, same as with m2m update
+		if filtering_results_bitmap:
+			Post.objects.filter(feed__in=feeds).update(filtering_mask=0, filtering_bits=0)
+		CrossrefRebuild.objects.schedule_full(feeds)
+
+FiltersPreview = namedtuple('FiltersPreview', 'results time')
+
 signals.m2m_changed.connect(Feed._filters_update_handler, sender=Feed.filters.through)
+signals.pre_delete.connect(Feed._filters_delete_handler_check, sender=Filter)
+signals.post_delete.connect(Feed._filters_delete_handler, sender=Filter)
+signals.pre_delete.connect(Feed._filters_delete_handler_check, sender=FilterBase)
+signals.post_delete.connect(Feed._filters_delete_handler, sender=FilterBase)
 
 # These two are purely to handle filters_logic field updates
 signals.pre_save.connect(Feed._filters_update_handler_check, sender=Feed)
@@ -397,6 +572,162 @@ signals.post_save.connect(Feed._filters_update_handler, sender=Feed)
 
 
 
+# Rebuilding filtering results can take minutes on large sites, so by default
+#  it's only recorded as CrossrefRebuild job on admin-initiated changes, to be
+#  processed later by feedjack_update or feedjack_rebuild commands.
+# Jobs, created during bulk update transaction, are always processed right away.
+crossref_rebuild_deferred = getattr(
+	settings, 'FEEDJACK_CROSSREF_REBUILD_DEFERRED', True )
+
+class CrossrefRebuilds(models.Manager):
+	def schedule(self, feeds, rebuild_order=None, date_threshold=None):
+		'''Create rebuild job for filtering results of specified feeds' posts,
+			processing it right away, unless it should be deferred.'''
+		job = self.create(rebuild_order=rebuild_order or '', date_threshold=date_threshold)
+		job.feeds = feeds
+		if not crossref_rebuild_deferred\
+			or transaction_in_progress.is_set(): job.process()
+		return job
+
+	def schedule_reset(self):
+		'''Drop all stored filtering results (both rows and bitmaps)
+			and schedule full rebuild for all feeds with filters.'''
+		feeds = list(Feed.objects.filter(filters__isnull=False).distinct())
+		FilterResult.objects.filter(post__feed__in=feeds).delete()
+		Post.objects.filter(feed__in=feeds).update(filtering_mask=0, filtering_bits=0)
+		return self.schedule_full(feeds)
+
+	def schedule_full(self, feeds):
+		'''Schedule rebuild of all filtering results for feeds,
+			grouped into jobs by their crossref filters' ordering.'''
+		orders = defaultdict(list)
+		for feed in feeds:
+			order = FilterBase.objects.filter(crossref=True, filters__feeds=feed)\
+				.values_list('crossref_timeline', flat=True)[:1]
+			orders['date_{0}'.format(FILTER_CR_TIMELINE_MAP[order[0]]) if order else None].append(feed)
+		return list(self.schedule(feeds, order) for order, feeds in orders.iteritems())
+
+	def process_pending(self, **kwz):
+		'Process all pending jobs in order of their creation, returning their count.'
+		jobs = list(self.get_query_set().order_by('id'))
+		for job in jobs: job.process(**kwz)
+		return len(jobs)
+
+
+class CrossrefRebuild(models.Model):
+	objects = CrossrefRebuilds()
+
+	feeds = models.ManyToManyField(Feed, related_name='crossref_rebuilds')
+	rebuild_order = models.CharField( max_length=32, blank=True,
+		help_text='Post timestamp field to walk posts (and check date_threshold) by.' )
+	date_threshold = models.DateTimeField( blank=True, null=True,
+		help_text='Only results for posts newer than that are rebuilt.' )
+
+	date_created = models.DateTimeField(auto_now_add=True)
+	date_started = models.DateTimeField(blank=True, null=True)
+	posts_total = models.PositiveIntegerField(blank=True, null=True)
+	posts_done = models.PositiveIntegerField(default=0)
+	# Position (rebuild_order value and id) of the last processed post, to resume from
+	last_post_id = models.PositiveIntegerField(blank=True, null=True)
+	last_post_date = models.DateTimeField(blank=True, null=True)
+
+	class Meta:
+		ordering = ('id',)
+
+	def __unicode__(self):
+		return u'#{0.id} ({0.posts_done}/{0.posts_total} posts'\
+			u' of {1} feed(s), since {0.date_threshold})'.format(self, self.feeds.count())
+
+	def _drop_crossref_bits(self, feeds):
+		meta, qn = Post._meta, connection.ops.quote_name
+		column = lambda name: qn(meta.get_field(name).column)
+		cursor = connection.cursor()
+		for feed in feeds:
+			drop = sum( 1 << slot for slot, filter_obj
+				in enumerate(feed.filters_slots()) if filter_obj.base.crossref )
+			if not drop: continue
+			query, params = ['UPDATE {0} SET {1} = {1} & %s WHERE {2} = %s'.format(
+				qn(meta.db_table), column('filtering_mask'), column('feed') )], [~drop, feed.id]
+			if self.date_threshold:
+				query.append('AND {0} > %s'.format(column(self.rebuild_order)))
+				params.append(self.date_threshold)
+			cursor.execute(' '.join(query), params)
+		transaction.commit_unless_managed()
+
+	def _posts_resume(self, posts):
+		'Filter posts, following the last processed one in (rebuild_order, id) order.'
+		if self.last_post_id is None: return posts
+		if not self.rebuild_order: return posts.filter(id__gt=self.last_post_id)
+		key = self.rebuild_order
+		if self.last_post_date is None: # NULLs are sorted last (in PostgreSQL)
+			return posts.filter(**{'{0}__isnull'.format(key): True, 'id__gt': self.last_post_id})
+		return posts.filter( Q(**{'{0}__gt'.format(key): self.last_post_date})
+			| Q(**{key: self.last_post_date, 'id__gt': self.last_post_id})
+			| Q(**{'{0}__isnull'.format(key): True}) )
+
+	def process(self, chunk=200, progress=None):
+		'''Drop crossref filtering results for job feeds' posts (newer than
+				date_threshold, if any), then re-check all these posts in rebuild_order.
+			Job state is saved after each "chunk" of posts (and passed to "progress"
+				callback, if any), so interrupted job can be resumed from there.
+			Job is removed when done.'''
+		lock, Feed._filters_update_handler_lock = Feed._filters_update_handler_lock, True
+		try:
+			feeds = set(self.feeds.all()) # so it won't generate repeated queries
+			# Changes from the interrupted run are unknown, so resumed job invalidates whole sites
+			resumed, changed = bool(self.date_started), list()
+			posts = Post.objects.filter(feed__in=feeds)
+			if self.date_threshold:
+				posts = posts.filter(**{ '{0}__gt'\
+					.format(self.rebuild_order): self.date_threshold })
+			if not self.date_started:
+				# Note that local update-date is checked, not the remote "date_modified" field.
+				if filtering_results_bitmap: self._drop_crossref_bits(feeds)
+				else:
+					tainted = FilterResult.objects.filter(
+						post__feed__in=feeds, filter__base__crossref=True )
+					if self.date_threshold:
+						tainted = tainted.filter(**{ 'post__{0}__gt'\
+							.format(self.rebuild_order): self.date_threshold })
+					tainted.delete()
+				self.date_started, self.posts_done = datetime.now(), 0
+				self.last_post_id = self.last_post_date = None
+			# Posts are updated in the "last-touched" order, for consistency of cross-ref filters' results.
+			# Resumed job continues after last processed post, so posts added
+			#  or removed since then won't shift anything, unlike with positional offsets.
+			posts = self._posts_resume(posts).order_by(*filter(None, [self.rebuild_order, 'id']))
+			keys = list( posts.values_list('id', self.rebuild_order) if self.rebuild_order
+				else ((post_id, None) for post_id in posts.values_list('id', flat=True)) )
+			self.posts_total = self.posts_done + len(keys)
+			self.save()
+			for n in xrange(0, len(keys), chunk):
+				post_ids = list(it.imap(op.itemgetter(0), keys[n:n+chunk]))
+				chunk_posts = dict( (post.id, post) for post in
+					Post.objects.filter(id__in=post_ids).select_related('feed') )
+				Post.filtering_results_precompute(chunk_posts.itervalues())
+				for post_id in post_ids:
+					try: post = chunk_posts[post_id]
+					except KeyError: continue # removed since job was started
+					if post.filtering_result_update(): changed.append(post.id)
+				self.posts_done += len(post_ids)
+				self.last_post_id, self.last_post_date = keys[n+len(post_ids)-1]
+				self.save()
+				if progress: progress(self)
+			if resumed:
+				sites = list(Site.objects.filter(subscriber__feed__in=feeds)\
+					.values_list('id', flat=True).distinct())
+				invalidate = lambda: map(fjcache.cache_delsite, sites)
+			else: invalidate = ft.partial(Post.cache_invalidate, changed)
+			# Invalidating cache before commit would allow it to be re-filled from old data
+			if transaction_in_progress.is_set(): transaction_cache_invalidate.append(invalidate)
+			else: invalidate()
+			self.delete()
+			# feedjack_update flushes these into the run summary
+			if not transaction_in_progress.is_set(): FilterBase.stats_flush()
+		finally: Feed._filters_update_handler_lock = lock
+
+
+
 class Tag(models.Model):
 	name = models.CharField(_('name'), max_length=127, unique=True)
 
@@ -440,13 +771,19 @@ class PostQuerySet(models.query.QuerySet):
 		return self.extra(where=funcs, params=params)
 
 	def with_criterias(self, site, feed=None, tag=None, since=None):
-		self = self.filter(feed__subscriber__site=site)
+		if site is not None: self = self.filter(feed__subscriber__site=site)
 		if feed is not None: self = self.filter(feed=feed)
 		if tag: self = self.filter(tags__name=tag)
 		if since: self = self.filter(date_modified__gt=since)
 		return self
 
-	def sorted(self, site_ordering_id, force=None):
+	def sorted(self, site_ordering_id, force=None, timeline=False):
+		'''Order posts as specified by SITE_ORDERING value.
+			"timeline" should be used for querysets, joined with SitePost (site listing) table.'''
+		if timeline:
+			prime = '-timeline__sort_key' if force != 'asc' else 'timeline__sort_key'
+			return self.order_by(prime, 'timeline__feed', '-timeline__date_created', '-id')
+
 		prime = Post._get_ordering_attribute(site_ordering_id)
 		if site_ordering_id == SITE_ORDERING.created_day:
 			# Requires more handling than just raw attribute name
@@ -458,7 +795,37 @@ class PostQuerySet(models.query.QuerySet):
 		if force == 'asc': prime = prime.lstrip('-')
 		elif force == 'desc' and prime[0] != '-': prime = '-{}'.format(prime)
 
-		return self.order_by(prime, 'feed', '-date_created')
+		# id is only there to make ordering unambiguous (for "seek")
+		return self.order_by(prime, 'feed', '-date_created', '-id')
+
+	def seek(self, site_ordering_id, post, force=None, backwards=False):
+		'''Posts after (or before, if "backwards") specified one in the "sorted" order.
+			Used for keyset pagination, which - unlike OFFSET - doesn't make db
+				scan and discard all the rows on preceding pages.
+			Ordering itself should be applied (and reversed, if backwards) separately.'''
+		prime = Post._get_ordering_attribute(site_ordering_id)
+		desc = force != 'asc'
+		keys = [ (prime, desc, getattr(post, prime)), ('feed', False, post.feed_id),
+			('date_created', True, post.date_created), ('id', True, post.id) ]
+		if backwards: keys = list((k, not desc, v) for k, desc, v in keys)
+
+		by_day = site_ordering_id == SITE_ORDERING.created_day
+		def cmp(n, key, desc, val, eq=False):
+			if n or not by_day:
+				return {key: val} if eq else {'{0}__{1}'.format(key, 'lt' if desc else 'gt'): val}
+			# date_trunc('day', date_created) comparisons as ranges of raw values
+			val = datetime(val.year, val.month, val.day)
+			if eq: return dict(date_created__gte=val, date_created__lt=val + timedelta(1))
+			return dict(date_created__lt=val) if desc\
+				else dict(date_created__gte=val + timedelta(1))
+
+		conds = list()
+		for n, (key, desc, val) in enumerate(keys):
+			cond = dict()
+			for m, (k, d, v) in enumerate(keys[:n]): cond.update(cmp(m, k, d, v, eq=True))
+			cond.update(cmp(n, key, desc, val))
+			conds.append(Q(**cond))
+		return self.filter(reduce(op.or_, conds))
 
 
 class Posts(models.Manager):
@@ -472,6 +839,13 @@ class Posts(models.Manager):
 		# Check is "not False" because there can be NULLs for
 		#  feeds with no filters (also provided there never was any filters).
 		# TODO: make this field pure-bool?
+		if for_display and site and site_timeline:
+			# All visibility checks are pre-calculated in SitePost, and conditions
+			#  on it have to be in the same filter() call to use the same join
+			timeline = dict(timeline__site=site, timeline__visible=True)
+			if criterias.get('feed') is not None: timeline['timeline__feed'] = criterias.pop('feed')
+			return self.get_query_set().filter(**timeline).with_criterias(None, **criterias)
+
 		posts = self.get_query_set().exclude(filtering_result=False)
 		if for_display:
 			posts = posts.exclude(hidden=True)
@@ -479,6 +853,9 @@ class Posts(models.Manager):
 		return posts.with_criterias(site, **criterias) if site else posts
 
 
+# Max length of Post.content_text excerpt
+POST_EXCERPT_LENGTH = getattr(settings, 'FEEDJACK_POST_EXCERPT_LENGTH', 1000)
+
 class Post(models.Model):
 	objects = Posts()
 
@@ -486,6 +863,11 @@ class Post(models.Model):
 	title = models.CharField(_('title'), max_length=2047)
 	link = models.URLField(_('link'), max_length=2047) # look at hashify.me for reasoning behind 2k+ length
 	content = models.TextField(_('content'), blank=True)
+	# Derived from content on fetch/change (see content_process), to avoid doing it on render
+	# NULL means "not processed yet", as empty string can be a valid result.
+	content_clean = models.TextField(null=True, blank=True, editable=False)
+	content_thumb = models.TextField(null=True, blank=True, editable=False)
+	content_text = models.TextField(null=True, blank=True, editable=False)
 	date_modified = models.DateTimeField(_('date modified'), null=True, blank=True)
 	guid = models.CharField(_('guid'), max_length=511, db_index=True)
 	author = models.CharField(_('author'), max_length=255, blank=True)
@@ -498,12 +880,15 @@ class Post(models.Model):
 
 	# These two will be quite different from date_modified, since date_modified is
 	#  parsed from the feed itself, and should always be earlier than either of two
-	date_created = models.DateTimeField(_('date created'), auto_now_add=True)
+	date_created = models.DateTimeField(_('date created'), auto_now_add=True, db_index=True)
 	date_updated = models.DateTimeField(_('date updated'), auto_now=True)
 
 	# This one is an aggregate of filtering_results, for performance benefit
 	filtering_result = models.NullBooleanField()
 	# filtering_results (reverse fk from FilterResult)
+	# Used instead of filtering_results with FEEDJACK_FILTERING_BITMAP setting
+	filtering_mask = models.BigIntegerField(default=0, editable=False)
+	filtering_bits = models.BigIntegerField(default=0, editable=False)
 
 	class Meta:
 		verbose_name = _('post')
@@ -532,29 +917,35 @@ class Post(models.Model):
 	def _filtering_result_checked(self, by_or):
 		'''Check if post passes all / at_least_one (by_or parameter) filter(s).
 			Filters are evaluated on only-if-necessary ("lazy") basis.'''
-		filters, results = it.imap(set, ( self.feed.filters.all(),
-			self.filtering_results.values_list('filter', flat=True) ))
+		if filtering_results_bitmap: return self._filtering_result_checked_bitmap(by_or)
+		filters = dict( (filter_obj.id, filter_obj)
+			for filter_obj in self.feed.filters.select_related('base') )
+		filter_ids, results = set(filters),\
+			set(self.filtering_results.values_list('filter', flat=True))
 
 		# Check if conclusion can already be made, based on cached results.
-		if results.issubset(filters):
+		if results.issubset(filter_ids):
 			# If at least one failed/passed test is already there, and/or outcome is defined.
 			try: return self._filtering_result(by_or)
 			except IndexError: # inconclusive until results are consistent
-				if filters == results: return not by_or
+				if filter_ids == results: return not by_or
 
 		# Consistency check / update.
-		if filters != results:
+		if filter_ids != results:
 			# Drop obsolete (removed, unbound from feed)
 			#  filters' results (they WILL corrupt outcome).
-			self.filtering_results.filter(filter__in=results.difference(filters)).delete()
+			self.filtering_results.filter(filter__in=results.difference(filter_ids)).delete()
 			# One more try, now that results are only from feed filters' subset.
 			try: return self._filtering_result(by_or)
 			except IndexError: pass
 			# Check if any filter-results are not cached yet, create them (perform actual filtering).
 			# Note that independent filters applied first, since
 			#  crossrefs should be more resource-hungry in general.
-			for filter_obj in sorted(filters.difference(results), key=op.attrgetter('base.crossref')):
-				filter_op = FilterResult(filter=filter_obj, post=self, result=filter_obj.handler(self))
+			for filter_obj in sorted( it.imap(filters.get, filter_ids.difference(results)),
+					key=op.attrgetter('base.crossref') ):
+				result, run_time, queries = filter_handler_timed(filter_obj, self)
+				filters_stats_add(filter_obj.base_id, result, run_time, queries)
+				filter_op = FilterResult(filter=filter_obj, post=self, result=result)
 				filter_op.save()
 				if filter_op.result == by_or: return by_or # return as soon as first passed / failed
 
@@ -562,12 +953,128 @@ class Post(models.Model):
 		try: return self._filtering_result(by_or)
 		except IndexError: return not by_or # none passed / none failed
 
+	def _filtering_result_checked_bitmap(self, by_or):
+		'Same as _filtering_result_checked, but using filtering bitmaps for results.'
+		filters = self.feed.filters_slots()
+		mask = self.filtering_mask & ((1 << len(filters)) - 1)
+		bits = self.filtering_bits & mask
+		try:
+			# Check if conclusion can already be made, based on cached results.
+			if bits if by_or else mask & ~bits: return by_or
+			# Note that independent filters applied first, since
+			#  crossrefs should be more resource-hungry in general.
+			for slot, filter_obj in sorted( enumerate(filters),
+					key=lambda (slot, filter_obj): filter_obj.base.crossref ):
+				slot = 1 << slot
+				if mask & slot: continue
+				result, run_time, queries = filter_handler_timed(filter_obj, self)
+				filters_stats_add(filter_obj.base_id, result, run_time, queries)
+				mask |= slot
+				if result: bits |= slot
+				if bool(result) == by_or: return by_or # return as soon as first passed / failed
+			return not by_or # none passed / none failed
+		finally:
+			if (mask, bits) != (self.filtering_mask, self.filtering_bits):
+				self.filtering_mask, self.filtering_bits = mask, bits
+				# Doesn't trigger any hooks, unlike save()
+				Post.objects.filter(id=self.id).update(filtering_mask=mask, filtering_bits=bits)
+
+	@staticmethod
+	def filtering_results_precompute(posts):
+		'''Calculate all missing non-crossref filtering results for a batch of
+				posts in a process pool, if enabled via FEEDJACK_FILTERS_PROCESSES setting.
+			Results of such filters depend only on the post itself, so it's safe to do
+				in any order, leaving only crossref filters to filtering_result_update.'''
+		if not filters_processes or not posts: return
+		posts, feed_filters, tasks = list(posts), dict(), list()
+		if filtering_results_bitmap:
+			known = lambda post, slot, filter_obj: post.filtering_mask & slot
+		else:
+			results = set(FilterResult.objects.filter( post__in=list(
+				it.imap(op.attrgetter('id'), posts) ) ).values_list('post', 'filter'))
+			known = lambda post, slot, filter_obj: (post.id, filter_obj.id) in results
+		for post in posts:
+			if post.feed_id not in feed_filters:
+				feed_filters[post.feed_id] = list( (1 << slot, filter_obj)
+					for slot, filter_obj in enumerate(post.feed.filters_slots())
+					if not filter_obj.base.crossref )
+			tasks.extend( (post, slot, filter_obj)
+				for slot, filter_obj in feed_filters[post.feed_id]
+				if not known(post, slot, filter_obj) )
+		if not tasks: return
+		results = _filters_pool().imap( _filter_handler_call,
+			( (filter_obj.base.name, filter_obj.base.handler_name, filter_obj.parameter, post)
+				for post, slot, filter_obj in tasks ),
+			chunksize=len(tasks) // (filters_processes * 4) + 1 )
+		for (post, slot, filter_obj), (result, run_time, queries) in it.izip(tasks, results):
+			filters_stats_add(filter_obj.base_id, result, run_time, queries)
+			if not filtering_results_bitmap:
+				FilterResult(filter=filter_obj, post=post, result=result).save()
+			else:
+				post.filtering_mask |= slot
+				if result: post.filtering_bits |= slot
+		if filtering_results_bitmap:
+			for post in set(it.imap(op.itemgetter(0), tasks)):
+				Post.objects.filter(id=post.id).update(
+					filtering_mask=post.filtering_mask, filtering_bits=post.filtering_bits )
+
 	def filtering_result_update(self):
 		filtering_result = self._filtering_result_checked(
 			by_or=(self.feed.filters_logic == FEED_FILTERING_LOGIC.any) )
 		if self.filtering_result != filtering_result:
 			self.filtering_result = filtering_result
 			self.save()
+			return True
+		return False
+
+	@staticmethod
+	def cache_invalidate(post_ids, tags=tuple(), feeds=tuple(), chunk=500):
+		'''Invalidate cached pages that might list any of the specified posts:
+				ones for their feeds and tags (plus any extra "tags" and "feeds" passed,
+				e.g. removed ones), and non-specific pages of sites these feeds are on.
+			Returns a list of ids of these sites.'''
+		feeds, tags, post_ids = set(feeds), set(tags), list(post_ids)
+		for n in xrange(0, len(post_ids), chunk):
+			chunk_ids = post_ids[n:n+chunk]
+			feeds.update(Post.objects.filter(id__in=chunk_ids).values_list('feed', flat=True))
+			tags.update(Tag.objects.filter(post__id__in=chunk_ids).values_list('name', flat=True))
+		if not feeds and not tags: return list()
+		sites = list(Site.objects.filter(subscriber__feed__in=feeds)\
+			.values_list('id', flat=True).distinct())
+		fjcache.cache_invalidate(list(it.chain(
+			it.imap(fjcache.ns_posts, sites),
+			it.imap(fjcache.ns_feed, feeds), it.imap(fjcache.ns_tag, tags) )))
+		return sites
+
+
+	def content_process(self):
+		'Update fields, derived from content, should be called on any changes to it.'
+		if not self.content:
+			self.content_clean = self.content_thumb = self.content_text = ''
+			return
+		from feedjack.fjlib import html_cleaner, html_thumbnail,\
+			html_text, html_text_truncate, html_errors
+		from django.utils.html import escape, strip_tags
+		try:
+			self.content_clean = html_cleaner(self.content)
+			self.content_thumb = html_thumbnail(self.content)
+			self.content_text = html_text(self.content, POST_EXCERPT_LENGTH)
+		except html_errors: # shouldn't prevent post from being stored
+			self.content_clean, self.content_thumb = escape(self.content), ''
+			self.content_text = html_text_truncate(strip_tags(self.content), POST_EXCERPT_LENGTH)
+
+	def _content_derived(self, field):
+		# Produced on demand for posts fetched before these fields were stored,
+		#  which can be filled in by "feedjack_rebuild --content"
+		if self.content_clean is None: self.content_process()
+		return getattr(self, field)
+
+	content_safe = property( lambda s: s._content_derived('content_clean'),
+		doc='Sanitized html content.' )
+	content_thumbnail = property( lambda s: s._content_derived('content_thumb'),
+		doc='Html fragment (first image, if any) to represent post in grid-like layouts.' )
+	content_excerpt = property( lambda s: s._content_derived('content_text'),
+		doc='Plain-text excerpt from the content.' )
 
 
 	def __unicode__(self): return self.title
@@ -576,6 +1083,8 @@ class Post(models.Model):
 
 	@staticmethod
 	def _update_handler(sender, instance, delete=False, **kwz):
+		# Posts, updated by the rebuild itself, shouldn't trigger another one
+		if Feed._filters_update_handler_lock: return
 		if transaction_in_progress.is_set():
 			# In case of post_delete hook, added object is not in db anymore
 			transaction_affected_feeds[instance.feed].add(instance)
@@ -587,8 +1096,121 @@ class Post(models.Model):
 			finally: instance._update_handler_call = False
 	_update_handler_call = False # flag to avoid recursion in filtering_result_update
 
+	# Cache is invalidated by feedjack_update (after commit) and CrossrefRebuild
+	#  for all changes these make, hooks below are for any other ones (e.g. from admin).
+
+	@staticmethod
+	def _cache_handler_check(sender, instance, **kwz):
+		if Feed._filters_update_handler_lock or transaction_in_progress.is_set(): return
+		# Tag relations are removed before post_delete
+		instance._cache_tags = list(instance.tags.values_list('name', flat=True))
+	_cache_tags = tuple()
+
+	@staticmethod
+	def _cache_handler(sender, instance, delete=False, **kwz):
+		if Feed._filters_update_handler_lock or transaction_in_progress.is_set(): return
+		if not delete: Post.cache_invalidate([instance.id])
+		else: Post.cache_invalidate(list(), tags=instance._cache_tags, feeds=[instance.feed_id])
+
+	@staticmethod
+	def _cache_tags_handler(sender, instance, action, reverse, pk_set=None, **kwz):
+		if Feed._filters_update_handler_lock or transaction_in_progress.is_set(): return
+		if reverse: return # changes to Tag objects, not posts
+		if action == 'pre_clear': Post._cache_handler_check(sender, instance)
+		elif action == 'post_clear': Post.cache_invalidate([instance.id], tags=instance._cache_tags)
+		elif action in ('post_add', 'post_remove'):
+			Post.cache_invalidate( [instance.id], tags=Tag.objects\
+				.filter(id__in=pk_set or list()).values_list('name', flat=True) )
+
 signals.post_save.connect(Post._update_handler, sender=Post)
 signals.post_delete.connect(ft.partial(Post._update_handler, delete=True), sender=Post)
+signals.post_save.connect(Post._cache_handler, sender=Post)
+signals.pre_delete.connect(Post._cache_handler_check, sender=Post)
+signals.post_delete.connect(ft.partial(Post._cache_handler, delete=True), sender=Post)
+signals.m2m_changed.connect(Post._cache_tags_handler, sender=Post.tags.through)
+
+
+
+class TagCounts(models.Manager):
+
+	def update_counts(self, feed_id, tag_ids, delta):
+		'''Add delta to post counters for specified tags of a feed.
+			Counters are clamped at zero (e.g. if these've drifted), as going below
+				it violates CHECK constraint and aborts the whole transaction on some dbs.'''
+		for tag_id in tag_ids:
+			counts = self.filter(feed=feed_id, tag=tag_id)
+			if delta < 0:
+				if not counts.filter(count__gte=-delta).update(count=F('count') + delta):
+					counts.filter(count__gt=0).update(count=0)
+			elif not counts.update(count=F('count') + delta):
+				self.get_or_create(feed_id=feed_id, tag_id=tag_id, defaults=dict(count=delta))
+
+	def rebuild(self):
+		'Re-calculate all counters from scratch.'
+		qn = connection.ops.quote_name
+		cursor = connection.cursor()
+		cursor.execute('DELETE FROM {0}'.format(qn(TagCount._meta.db_table)))
+		cursor.execute(
+			'INSERT INTO {t} (feed_id, tag_id, count)'
+			' SELECT post.feed_id, post_tags.tag_id, COUNT(*)'
+			' FROM {post_tags} post_tags JOIN {post} post ON post.id = post_tags.post_id'
+			' GROUP BY post.feed_id, post_tags.tag_id'.format(
+				t=qn(TagCount._meta.db_table), post=qn(Post._meta.db_table),
+				post_tags=qn(Post.tags.through._meta.db_table) ) )
+		transaction.commit_unless_managed()
+
+
+class TagCount(models.Model):
+	'''Number of posts with a tag in a feed, kept up to date
+		on post tags' changes, so tag clouds don't have to count posts.
+		Changes of the Post.feed itself are not tracked.'''
+	objects = TagCounts()
+
+	feed = models.ForeignKey(Feed, related_name='tag_counts')
+	tag = models.ForeignKey(Tag, related_name='counts')
+	count = models.PositiveIntegerField(default=0)
+
+	class Meta:
+		unique_together = (('feed', 'tag'),)
+
+	def __unicode__(self): return u'{0}: {1}'.format(self.tag_id, self.count)
+
+
+	@staticmethod
+	def _post_tags_handler(sender, instance, action, reverse, pk_set, **kwz):
+		if action == 'post_clear':
+			pairs, instance._tag_counts_cleared = getattr(instance, '_tag_counts_cleared', None), None
+			for feed_id, tag_ids in pairs or list():
+				TagCount.objects.update_counts(feed_id, tag_ids, -1)
+			return
+		if action not in ['post_add', 'pre_remove', 'pre_clear']: return
+
+		# Only relations that actually exist (or were just added) are counted
+		if reverse: # tag.post_set changes, pk_set - post ids
+			posts = Post.objects.filter(id__in=pk_set)\
+				if action == 'post_add' else Post.objects.filter(tags=instance)
+			if action == 'pre_remove': posts = posts.filter(id__in=pk_set)
+			pairs = list( (feed_id, [instance.id])
+				for feed_id in posts.values_list('feed', flat=True) )
+		else:
+			tag_ids = list(pk_set) if action == 'post_add'\
+				else instance.tags.values_list('id', flat=True)
+			if action == 'pre_remove': tag_ids = tag_ids.filter(id__in=pk_set)
+			pairs = [(instance.feed_id, list(tag_ids))]
+
+		if action == 'pre_clear': instance._tag_counts_cleared = pairs
+		else:
+			for feed_id, tag_ids in pairs:
+				TagCount.objects.update_counts(feed_id, tag_ids, 1 if action == 'post_add' else -1)
+
+	@staticmethod
+	def _post_delete_handler(sender, instance, **kwz):
+		# m2m rows are removed without any m2m_changed signals
+		TagCount.objects.update_counts( instance.feed_id,
+			instance.tags.values_list('id', flat=True), -1 )
+
+signals.m2m_changed.connect(TagCount._post_tags_handler, sender=Post.tags.through)
+signals.pre_delete.connect(TagCount._post_delete_handler, sender=Post)
 
 
 
@@ -630,15 +1252,116 @@ class Subscriber(models.Model):
 			instance._relation_update = (
 				instance.site != pre_instance.site
 					or instance.feed != pre_instance.feed )
-	_relation_update = None
+			instance._relation_pre = pre_instance.site_id, pre_instance.feed_id
+	_relation_update = _relation_pre = None
 
 	@staticmethod
 	def _update_handler(sender, instance, created, **kwz):
 		if created: return
 		if instance._relation_update: Feed.update_handler(instance.feed)
 
+	@staticmethod
+	def _timestamps_handler(sender, instance, **kwz):
+		site_ids = filter(None, [ instance.site_id,
+			instance._relation_pre and instance._relation_pre[0] ])
+		Site.feeds_timestamps_update(site_ids)
+		fjcache.sites_version_bump()
+		# Subscribers' names and feed lists are displayed on every page
+		for site_id in set(site_ids): fjcache.cache_delsite(site_id)
+
 signals.pre_save.connect(Subscriber._update_handler_check, sender=Subscriber)
 signals.post_save.connect(Subscriber._update_handler, sender=Subscriber)
+signals.post_save.connect(Subscriber._timestamps_handler, sender=Subscriber)
+signals.post_delete.connect(Subscriber._timestamps_handler, sender=Subscriber)
+
+
+
+# Denormalized per-site post listings, used instead of post-feed-subscriber-site
+#  joins for site pages. Should be (re-)built via "feedjack_rebuild --timeline"
+#  after enabling, as only changes are tracked.
+site_timeline = getattr(settings, 'FEEDJACK_SITE_TIMELINE', False)
+
+class SitePosts(models.Manager):
+
+	def rebuild(self, site=None, feed=None, post=None):
+		'''Re-create entries for all posts of a site, feed and/or single post
+			(or all entries, if nothing is specified), with a couple of bulk queries.'''
+		qn = connection.ops.quote_name
+		# (sitepost column, same value in the select below, value)
+		where = list( (col, src, getattr(val, 'id', val)) for col, src, val in [
+				('site_id', 'sub.site_id', site), ('feed_id', 'post.feed_id', feed),
+				('post_id', 'post.id', post) ] if val is not None )
+		where_sql = lambda idx: 'WHERE {0}'.format(' AND '.join(
+			'{0} = %s'.format(cond[idx]) for cond in where )) if where else ''
+		params = map(op.itemgetter(2), where)
+
+		cursor = connection.cursor()
+		cursor.execute( 'DELETE FROM {0} {1}'.format(
+			qn(SitePost._meta.db_table), where_sql(0) ), params )
+		cursor.execute(
+			'INSERT INTO {t} (site_id, feed_id, post_id, visible, sort_key, date_created)'
+			' SELECT sub.site_id, post.feed_id, post.id,'
+				' post.filtering_result IS NOT false AND NOT post.hidden AND sub.is_active,'
+				' CASE site.order_posts_by'
+					' WHEN {o.modified} THEN post.date_modified'
+					' WHEN {o.created} THEN post.date_created'
+					" ELSE date_trunc('day', post.date_created) END,"
+				' post.date_created'
+			' FROM {post} post'
+				' JOIN {sub} sub ON sub.feed_id = post.feed_id'
+				' JOIN {site} site ON site.id = sub.site_id'
+			' {where}'.format(
+				t=qn(SitePost._meta.db_table), post=qn(Post._meta.db_table),
+				sub=qn(Subscriber._meta.db_table), site=qn(Site._meta.db_table),
+				o=SITE_ORDERING, where=where_sql(1) ), params )
+		transaction.commit_unless_managed()
+
+
+class SitePost(models.Model):
+	'''Post entry in a site listing, with sort_key for the site ordering
+		(Site.order_posts_by) and visibility (filtering, hidden flag, subscriber status).
+		Intended to be used with composite indexes, described in CHANGES_DATABASE.'''
+	objects = SitePosts()
+
+	site = models.ForeignKey(Site, related_name='timeline')
+	feed = models.ForeignKey(Feed, related_name='timeline')
+	post = models.ForeignKey(Post, related_name='timeline')
+	visible = models.BooleanField()
+	sort_key = models.DateTimeField(null=True)
+	date_created = models.DateTimeField()
+
+	class Meta:
+		unique_together = (('site', 'post'),)
+
+	def __unicode__(self): return u'{0} on {1}'.format(self.post_id, self.site_id)
+
+
+	@staticmethod
+	def _post_handler(sender, instance, **kwz):
+		if site_timeline: SitePost.objects.rebuild(post=instance)
+
+	@staticmethod
+	def _subscriber_handler(sender, instance, delete=False, **kwz):
+		if not site_timeline: return
+		if instance._relation_update:
+			SitePost.objects.rebuild(*instance._relation_pre)
+		if delete: SitePost.objects.filter(site=instance.site_id, feed=instance.feed_id).delete()
+		else: SitePost.objects.rebuild(instance.site_id, instance.feed_id)
+
+	@staticmethod
+	def _site_handler_check(sender, instance, **kwz):
+		instance._timeline_update = site_timeline and instance.id\
+			and not Site.objects.filter(id=instance.id, order_posts_by=instance.order_posts_by).exists()
+
+	@staticmethod
+	def _site_handler(sender, instance, **kwz):
+		if getattr(instance, '_timeline_update', False): SitePost.objects.rebuild(site=instance)
+
+signals.post_save.connect(SitePost._post_handler, sender=Post)
+signals.post_save.connect(SitePost._subscriber_handler, sender=Subscriber)
+signals.post_delete.connect(ft.partial(SitePost._subscriber_handler, delete=True), sender=Subscriber)
+signals.pre_save.connect(SitePost._site_handler_check, sender=Site)
+signals.post_save.connect(SitePost._site_handler, sender=Site)
 
 
 
@@ -709,6 +1432,10 @@ def transaction_wrapper(func, logger=None):
 from threading import Event
 transaction_in_progress = Event()
 transaction_affected_feeds = defaultdict(set)
+transaction_cache_invalidate = list() # callables to run after commit
+
+def transaction_bulk_invalidate(signal, sender, **kwz):
+	while transaction_cache_invalidate: transaction_cache_invalidate.pop(0)()
 
 def transaction_bulk_start(signal, sender, **kwz):
 	transaction_in_progress.set()
@@ -726,8 +1453,10 @@ def transaction_bulk_finish(signal, sender, **kwz):
 	# Transaction should be already comitted/rolled-back at this point
 	transaction_in_progress.clear()
 	transaction_affected_feeds.clear()
+	del transaction_cache_invalidate[:]
 
 transaction_start.connect(transaction_bulk_start, sender='bulk_update')
 transaction_pre_commit.connect(transaction_bulk_process)
+transaction_post_commit.connect(transaction_bulk_invalidate)
 transaction_post_rollback.connect(transaction_bulk_cancel)
 transaction_finish.connect(transaction_bulk_finish, sender='bulk_update')
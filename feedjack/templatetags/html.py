@@ -8,7 +8,7 @@ from django import template
 register = template.Library()
 
 
-from feedjack.fjlib import html_cleaner
+from feedjack.fjlib import html_cleaner, html_text_truncate
 from django.utils.html import escape
 
 @register.filter
@@ -19,6 +19,18 @@ def prettyhtml(value, autoescape=None):
 		and not isinstance(value, SafeData) else mark_safe(value)
 
 
+# Filters for fields, pre-processed when post is fetched
+
+@register.filter
+def post_thumbnail(post):
+	return mark_safe(post.content_thumbnail)
+
+@register.filter
+def post_excerpt(post, length=None):
+	text = post.content_excerpt
+	return text if not length else html_text_truncate(text, int(length))
+
+
 # lxml is hard-dep in fern style only, at least initially
 try: from feedjack.fjlib import lxml_soup, lxml_tostring
 except ImportError: pass
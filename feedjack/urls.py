@@ -1,74 +1,107 @@
 # -*- coding: utf-8 -*-
 
 from django.conf.urls.defaults import patterns
+from django.http import Http404
 from feedjack import views
 
 
 import itertools as it, operator as op, functools as ft
 from types import StringTypes, NoneType
+import re
 
 specs = dict(feed=('feed', r'\d+'), tag=r'[^/]+', since=r'[^/]+', asc=None)
 specs_deprecated = dict(user=('feed', r'\d+'), tag=r'[^/]+')
 
-urljoin = lambda pieces: '/'.join(it.imap(op.methodcaller('strip', '/'), pieces))
-
-def specs_sets(tpl, specs, make_redirects=False):
-	if isinstance(specs, dict): specs = specs.items()
-	for spec_set in it.chain.from_iterable(
-			it.permutations(specs, n) for n in xrange(len(specs), 0, -1) ):
-		url = list()
-		for spec, pat in spec_set:
-			if not isinstance(pat, (StringTypes, NoneType)): pat_spec, pat = pat
-			else: pat_spec = spec
-			pat = '{}/(?P<{}>{})'.format(spec, pat_spec, pat)\
-				if pat is not None else '(?P<{}>{})'.format(pat_spec, spec)
-			if make_redirects: pat = (pat, '{}/%({})s'.format(spec, pat_spec))
-			url.append(pat)
-		yield tpl.format(urljoin(url)) if not make_redirects else\
-			( tpl.format(urljoin(it.imap(op.itemgetter(0), url))),
-				urljoin(it.imap(op.itemgetter(1), url)) )
-
-
-urlpatterns = list()
-
-# Long-ago deprecated syndication links, now just a redirects
-urlpatterns.extend([
+def specs_compile(specs):
+	'Returns dict of path segment -> (criteria name, compiled value regexp or None).'
+	specs_re = dict()
+	for spec, pat in specs.iteritems():
+		if not isinstance(pat, (StringTypes, NoneType)): pat_spec, pat = pat
+		else: pat_spec = spec
+		specs_re[spec] = pat_spec, re.compile(r'(?:{0})\Z'.format(pat), re.UNICODE) if pat is not None else None
+	return specs_re
+
+def specs_parse(path, specs_re):
+	'''Parse "spec/value/spec/..." path (with optional trailing slash)
+			into a dict of criterias, in one pass over path segments.
+		Each spec can be used at most once and in any order, valueless specs (like "asc")
+			get their own name as a value. Returns None if path doesn't match specs.'''
+	segments = path.split('/')
+	if len(segments) > 1 and not segments[-1]: segments.pop()
+	criterias, segments = dict(), iter(segments)
+	for spec in segments:
+		try: pat_spec, pat = specs_re[spec]
+		except KeyError: return None
+		if pat_spec in criterias: return None
+		if pat is None: value = spec
+		else:
+			value = next(segments, None)
+			if value is None or not pat.match(value): return None
+		criterias[pat_spec] = value
+	return criterias or None
+
+
+def feed_redirect(request, **criterias):
+	'Redirect from long-ago deprecated "feed/user/..." syndication links.'
+	return views.redirect(request, '/feed/atom/{0}'.format('/'.join(
+		'{0}/{1}'.format(spec, criterias[pat_spec].replace('%', '%%'))
+		for spec, pat_spec in [('user', 'feed'), ('tag', 'tag')] if pat_spec in criterias )))
+
+# Routes for criteria-style links, matched in order - prefix, specs, view
+specs_routes = list( (prefix, specs_compile(prefix_specs), view)
+	for prefix, prefix_specs, view in [
+		('feed', specs_deprecated, feed_redirect),
+		# New-style syndication links
+		('syndication/atom', specs, views.atomfeed),
+		('syndication/rss', specs, views.rssfeed),
+		# Deprecated syndication links
+		('feed/atom', specs_deprecated, views.atomfeed),
+		('feed/rss', specs_deprecated, views.rssfeed),
+		# New-style pages
+		('', specs, views.mainview),
+		# Deprecated pages, can overlap with new-style ones
+		('', specs_deprecated, views.mainview) ] )
+
+def specs_dispatch(request, path):
+	'Dispatches criteria-style (e.g. "feed/1/tag/x/asc/") links to a view.'
+	for prefix, specs_re, view in specs_routes:
+		if prefix:
+			if not path.startswith(prefix + '/'): continue
+			criterias = specs_parse(path[len(prefix)+1:], specs_re)
+		else: criterias = specs_parse(path, specs_re)
+		if criterias is not None: return view(request, **criterias)
+	raise Http404
+
+# Only paths starting with known route prefixes or specs are passed to specs_dispatch,
+#  so that any patterns after these (or APPEND_SLASH redirects) still work for others
+specs_dispatch_re = r'^(?P<path>(?:{0})(?:/.*)?)$'.format('|'.join(it.imap( re.escape,
+	sorted(set(filter(None, it.imap(op.itemgetter(0), specs_routes))).union(
+		it.chain.from_iterable(it.imap(op.itemgetter(1), specs_routes)))) )))
+
+
+urlpatterns = patterns('',
+	# Long-ago deprecated syndication links, now just a redirects
 	(r'^rss20.xml$', views.redirect, dict(url='/feed/rss/')),
-	(r'^feed/$', views.redirect, dict(url='/feed/atom/')) ])
-urlpatterns.extend( (src, views.redirect, dict(url='/feed/atom/{0}'.format(dst)))
-	for src,dst in specs_sets('^feed/{0}/?$', specs_deprecated, make_redirects=True) )
-
-# New-style syndication links
-urlpatterns.extend( (url, views.atomfeed)
-	for url in specs_sets('^syndication/atom/{0}/?$', specs) )
-urlpatterns.extend( (url, views.rssfeed)
-	for url in specs_sets('^syndication/rss/{0}/?$', specs) )
-urlpatterns.extend([
+	(r'^feed/?$', views.redirect, dict(url='/feed/atom/')),
+
+	# New-style syndication links
 	(r'^syndication/atom/?$', views.atomfeed),
 	(r'^syndication/rss/?$', views.rssfeed),
 	(r'^syndication/opml/?$', views.opml),
-	(r'^syndication/foaf/?$', views.foaf) ])
-
-# Deprecated syndication links
-urlpatterns.extend([
-	(r'^feed/atom/$', views.atomfeed),
-	(r'^feed/rss/$', views.rssfeed),
-	(r'^opml/$', views.opml),
-	(r'^foaf/$', views.foaf) ])
-urlpatterns.extend( (url, views.atomfeed)
-	for url in specs_sets('^feed/atom/{0}/?$', specs_deprecated) )
-urlpatterns.extend( (url, views.rssfeed)
-	for url in specs_sets('^feed/rss/{0}/?$', specs_deprecated) )
-
-# New-style pages
-urlpatterns.extend( (url, views.mainview)
-	for url in specs_sets('^{0}/?$', specs) )
-# Deprecated pages, can overlap with new-style ones
-urlpatterns.extend( (url, views.mainview)
-	for url in specs_sets('^{0}/?$', specs_deprecated) )
-# Ajax handlers
-urlpatterns.append((r'^ajax/store\.json$', views.ajax_store))
-# Index page
-urlpatterns.append((r'^$', views.mainview))
-
-urlpatterns = patterns('', *urlpatterns)
+	(r'^syndication/foaf/?$', views.foaf),
+
+	# Deprecated syndication links
+	# Trailing slash is optional in all static links, as catch-all pattern below
+	#  will match them otherwise, so APPEND_SLASH redirects won't work for these.
+	(r'^feed/atom/?$', views.atomfeed),
+	(r'^feed/rss/?$', views.rssfeed),
+	(r'^opml/?$', views.opml),
+	(r'^foaf/?$', views.foaf),
+
+	# Ajax handlers
+	(r'^ajax/store\.json$', views.ajax_store),
+	# Index page
+	(r'^$', views.mainview),
+
+	# Pages and syndication feeds with criterias (feed, tag, etc), parsed in specs_dispatch
+	(specs_dispatch_re, specs_dispatch) )
@@ -2,105 +2,278 @@
 
 
 from django.utils import feedgenerator
+from django.utils.xmlutils import SimplerXMLGenerator
 from django.shortcuts import render_to_response
 from django.http import HttpResponse, Http404,\
 	HttpResponsePermanentRedirect, HttpResponseBadRequest,\
 	HttpResponseNotModified
 from django.utils.cache import patch_vary_headers
+from django.utils.http import http_date
 from django.template import Context, RequestContext, loader
 from django.views.generic.simple import redirect_to
 from django.core.exceptions import ObjectDoesNotExist
 from django.utils import simplejson as json
 from django.utils.encoding import smart_unicode
 from django.views.decorators.http import condition
+from django.utils.text import compress_string
+from django.conf import settings
 
 from feedjack import models, fjlib, fjcache
 
 import itertools as it, operator as op, functools as ft
 from datetime import datetime
-from collections import defaultdict
+from collections import namedtuple
 from urlparse import urlparse
+from time import time, sleep
+from calendar import timegm
+from hashlib import md5
+from gzip import GzipFile
+from cStringIO import StringIO
+import sys, re
+
+try: import brotli
+except ImportError: brotli = None
+
+
+# Max time to wait for a page, concurrently regenerated by another request
+#  (and without stale copy of it available), before rendering it anyway.
+cache_lock_wait = getattr(settings, 'FEEDJACK_CACHE_LOCK_WAIT', 3)
+
+# Encoding to store cached pages' content with, "gzip" or "br" (requires brotli module).
+cache_encoding = getattr(settings, 'FEEDJACK_CACHE_ENCODING', 'gzip')
+if cache_encoding == 'br' and not brotli: cache_encoding = 'gzip'
+
+cache_encoders = dict(
+	gzip=( compress_string,
+		lambda content: GzipFile(fileobj=StringIO(content)).read() ),
+	br=(brotli and brotli.compress, brotli and brotli.decompress) )
+
+
+# Rendered page as it's stored in cache - compressed content and a few headers
+CachedPage = namedtuple('CachedPage', 'content encoding content_type last_modified etag')
+
+def cache_page(response, version):
+	'Build a cache entry from a rendered response and its page_version.'
+	etag, last_modified = version
+	return CachedPage( cache_encoders[cache_encoding][0](response.content),
+		cache_encoding, response['Content-Type'], last_modified, etag )
+
+class CacheStream(object):
+	'''Iterable response content, passing through chunks of a stream, compressing
+			these on the way, and storing cache entry for the page after the last one
+			(only if site uses internal cache, and only once).
+		Any further iteration (e.g. by middleware accessing response content)
+			replays the content, compressed on the first one, raising RuntimeError
+			if that first one wasn't consumed to the end.
+		Lock for page regeneration (if "unlock" is set, i.e. it's held by the request)
+			is released on close() (called by wsgi server), if it wasn't consumed
+			to the end - e.g. for HEAD requests or disconnected clients.'''
+
+	def __init__(self, stream, site, cachekey, namespaces, content_type, version, unlock=False):
+		self.stream, self.site, self.cachekey, self.namespaces =\
+			stream, site, cachekey, namespaces
+		self.content_type, self.version, self.unlock = content_type, version, unlock
+		self.started = self.done = False
+		self.content = None
+
+	def __iter__(self):
+		if self.content is not None:
+			return iter([cache_encoders[cache_encoding][1](self.content)])
+		if self.started:
+			raise RuntimeError( 'Streamed response content can'
+				' only be replayed after it was consumed to the end' )
+		self.started = True
+		return self._stream()
+
+	def _stream(self):
+		buff = StringIO()
+		if cache_encoding == 'gzip':
+			encoder = GzipFile(mode='wb', compresslevel=6, fileobj=buff)
+		else: encoder = buff # compressed in one go, as not all brotli versions can do it incrementally
+		for chunk in self.stream:
+			encoder.write(chunk)
+			yield chunk
+		if encoder is not buff:
+			encoder.close()
+			content = buff.getvalue()
+		else: content = cache_encoders[cache_encoding][0](buff.getvalue())
+		self.content = content
+		if self.site.use_internal_cache and not self.done:
+			etag, last_modified = self.version
+			fjcache.cache_set( self.site, self.cachekey, CachedPage( content,
+				cache_encoding, self.content_type, last_modified, etag ),
+				self.namespaces, unlock=self.unlock )
+		self.done = True
+
+	def close(self):
+		if not self.done and self.unlock: fjcache.cache_unlock(self.site.id, self.cachekey)
+		self.done = True
+
+def cached_response(request, page):
+	'''Build response from a cached page, compressed if client accepts
+		the encoding it's stored with. Non-cached responses (e.g. redirects) are returned as-is.'''
+	if not isinstance(page, CachedPage): return page
+	content = page.content
+	encoded = re.search( r'\b{0}\b'.format(page.encoding),
+		request.META.get('HTTP_ACCEPT_ENCODING', '') )
+	if not encoded: content = cache_encoders[page.encoding][1](content)
+	response = HttpResponse(content, content_type=page.content_type)
+	if encoded: response['Content-Encoding'] = page.encoding
+	response['Content-Length'] = str(len(content))
+	# Validators of the served page, which can be a stale copy, so that
+	#  @condition won't set these from the current (newer) page_version
+	response['ETag'] = '"{0}"'.format(page.etag)
+	if page.last_modified:
+		response['Last-Modified'] = http_date(timegm(page.last_modified.utctimetuple()))
+	patch_vary_headers(response, ['Host', 'Accept-Encoding'])
+	return response
+
 
+def page_version(request, **criterias):
+	'''Returns etag and last-modification time for a page, derived from
+			generation counters of its cache namespaces (bumped on any relevant
+			changes, and are time-based), so there's no need to have it cached or rendered.
+		Values are stored with cached pages, and are the same for these, unless cache
+			entry is stale. Both etag and last-modification time also change every
+			cache_duration, as pages can have time-dependent content,
+			so that If-Modified-Since won't match older ones. Returns Nones for redirects.'''
+	try: return request._feedjack_version
+	except AttributeError: pass
+	page, site, cachekey = initview(request, **criterias)
+	if isinstance(page, CachedPage): version = page.etag, page.last_modified
+	elif page is not None: version = None, None # redirect
+	else:
+		gens = fjcache.generations( [fjcache.ns_site(site.id)]
+			+ fjcache.page_namespaces(site.id, **criterias) )
+		duration = max(site.cache_duration, 1)
+		bucket = int(time() // duration)
+		version = md5(u'{0}--{1}--{2}'.format( cachekey,
+				'.'.join('{0}'.format(gen) for gen in gens), bucket ).encode('utf-8')).hexdigest(),\
+			datetime.utcfromtimestamp(max(max(gens) / 1000.0, bucket * duration))
+	request._feedjack_version = version
+	return version
 
 def cache_etag(request, *argz, **kwz):
-	'''Produce etag value for a cached page.
+	'''Produce etag value for a page, see page_version.
 		Intended for usage in conditional views (@condition decorator).'''
-	response, site, cachekey = initview(request)
-	if not response: return None
-	return fjcache.str2md5(
-		'{}--{}--{}'.format( site.id if site else 'x', cachekey,
-			response[1].strftime('%Y-%m-%d %H:%M:%S%z') ) )
+	return page_version(request, **kwz)[0]
 
 def cache_last_modified(request, *argz, **kwz):
-	'''Last modification date for a cached page.
+	'''Last modification date for a page, see page_version.
 		Intended for usage in conditional views (@condition decorator).'''
-	response, site, cachekey = initview(request)
-	if not response: return None
-	return response[1]
+	return page_version(request, **kwz)[1]
 
 
-def initview(request, response_cache=True):
+def initview(request, response_lock=False, **criterias):
 	'''Retrieves the basic data needed by all feeds (host, feeds, etc)
+		Criterias (feed, tag) determine cache namespaces for the response.
+		With response_lock, cache miss acquires a lock to regenerate the response,
+			so that concurrent requests would get its stale copy (or wait for
+			a fresh one) instead, and caller is expected to store the response.
+		Site lookup and cache fetch results are memoized on the request, as
+			conditional view helpers (etag, last-modified) and the view itself all need these.
 		Returns a tuple of:
-			1. A valid cached response or None
+			1. A valid cached page (CachedPage or redirect HttpResponse) or None
 			2. The current site object
 			3. The cache key
 			4. The subscribers for the site (objects)
 			5. The feeds for the site (ids)'''
 
+	try: response, site, cachekey = request._feedjack_initview
+	except AttributeError:
+		response, site, cachekey = request._feedjack_initview = _initview(request, **criterias)
+
+	if not response and response_lock and site.use_internal_cache\
+			and not fjcache.cache_lock(site.id, cachekey):
+		# Lock is held by another request, which will store the page
+		cache_ns = fjcache.page_namespaces(site.id, **criterias)
+		response = _cached_page(fjcache.cache_get_stale(site.id, cachekey))
+		deadline = time() + cache_lock_wait
+		while not response and time() < deadline:
+			sleep(0.1)
+			response = _cached_page(fjcache.cache_get(site.id, cachekey, cache_ns))
+		if response: request._feedjack_initview = response, None, cachekey
+	elif not response and response_lock and site.use_internal_cache:
+		request._feedjack_lock = True
+
+	return request._feedjack_initview
+
+def lock_owned(request):
+	'Whether page regeneration lock was acquired by initview for this request.'
+	return getattr(request, '_feedjack_lock', False)
+
+def render_lock(view):
+	'''Decorator for views, using initview with response_lock, to release
+		page regeneration lock if rendering fails (e.g. with Http404 for bad page number),
+		so that other requests won't have to wait for it to expire.'''
+	@ft.wraps(view)
+	def _view(request, *argz, **kwz):
+		try: return view(request, *argz, **kwz)
+		except:
+			exc_info = sys.exc_info() # can be replaced by exceptions, handled in cache backend
+			page, site, cachekey = getattr(request, '_feedjack_initview', (None, None, None))
+			if site is not None and lock_owned(request): fjcache.cache_unlock(site.id, cachekey)
+			raise exc_info[0], exc_info[1], exc_info[2]
+	return _view
+
+def _cached_page(data):
+	# Entries of any other format (e.g. from older feedjack versions) are ignored
+	return data if isinstance(data, CachedPage) else None
+
+# Sites with parsed urls, cached in-process until sites' version counter changes
+#  (on any Site save/delete) or "sites_refresh" seconds pass (version can be
+#  bumped before transaction with site changes gets committed).
+_sites = dict(version=None, ts=0, sites=list())
+sites_refresh = getattr(settings, 'FEEDJACK_SITES_REFRESH', 60)
+
+def site_resolve(http_host, path_info):
+	'''Select the most matching site possible, preferring "default" when
+			everything else is equal, without any db queries in most cases.
+		Returns a tuple of parsed site url and Site object, or Nones if there are no sites.'''
+	version, ts = fjcache.sites_version(), time()
+	if _sites['version'] != version or ts - _sites['ts'] > sites_refresh:
+		_sites.update( version=version, ts=ts, sites=list(
+			(urlparse(site.url), site) for site in models.Site.objects.all() ) )
+	match, match_relevance = (None, None), -1
+	for site_url, site in _sites['sites']:
+		relevance = 0
+		if site_url.netloc == http_host: relevance += 10 # host matches
+		if path_info.startswith(site_url.path.strip('/')): relevance += 10 # path matches
+		if site.default_site: relevance += 5 # marked as "default"
+		if relevance > match_relevance: match, match_relevance = (site_url, site), relevance
+	return match
+
+def _initview(request, response_cache=True, **criterias):
 	http_host, path_info = ( smart_unicode(part.strip('/')) for part in
 		[ request.META['HTTP_HOST'],
 			request.META.get('REQUEST_URI', request.META.get('PATH_INFO', '/')) ] )
 	query_string = request.META['QUERY_STRING']
 
-	url = '{}/{}'.format(http_host, path_info)
 	cachekey = u'{}?{}'.format(*it.imap(smart_unicode, (path_info, query_string)))
-	hostdict = fjcache.hostcache_get() or dict()
-
-	if url in hostdict:
-		site = models.Site.objects.get(pk=hostdict[url])
-
-	else:
-		sites = list(models.Site.objects.all())
-
-		if not sites:
-			# Somebody is requesting something, but the user
-			#  didn't create a site yet. Creating a default one...
-			site = models.Site(
-				name='Default Feedjack Site/Planet',
-				url='www.feedjack.org',
-				title='Feedjack Site Title',
-				description='Feedjack Site Description.'
-					' Please change this in the admin interface.' )
-			site.save()
-
-		else:
-			# Select the most matching site possible,
-			#  preferring "default" when everything else is equal
-			results = defaultdict(list)
-			for site in sites:
-				relevance, site_url = 0, urlparse(site.url)
-				if site_url.netloc == http_host: relevance += 10 # host matches
-				if path_info.startswith(site_url.path.strip('/')): relevance += 10 # path matches
-				if site.default_site: relevance += 5 # marked as "default"
-				results[relevance].append((site_url, site))
-			for relevance in sorted(results, reverse=True):
-				try: site_url, site = results[relevance][0]
-				except IndexError: pass
-				else: break
-			if site_url.netloc != http_host: # redirect to proper site hostname
-				# TODO: SERVER_PORT doesn't seem very useful here, but just "http://{}/" is just wrong
-				#  ...in a way that it doesn't respect port and protocol
-				response = HttpResponsePermanentRedirect(
-					'http://{}/{}{}'.format( site_url.netloc, path_info,
-						'?{}'.format(query_string) if query_string.strip() else '') )
-				return (response, datetime.now()), None, cachekey
-
-		hostdict[url] = site.id
-		fjcache.hostcache_set(hostdict)
+	site_url, site = site_resolve(http_host, path_info)
+
+	if not site:
+		# Somebody is requesting something, but the user
+		#  didn't create a site yet. Creating a default one...
+		site = models.Site(
+			name='Default Feedjack Site/Planet',
+			url='www.feedjack.org',
+			title='Feedjack Site Title',
+			description='Feedjack Site Description.'
+				' Please change this in the admin interface.' )
+		site.save()
+
+	elif site_url.netloc != http_host: # redirect to proper site hostname
+		# TODO: SERVER_PORT doesn't seem very useful here, but just "http://{}/" is just wrong
+		#  ...in a way that it doesn't respect port and protocol
+		response = HttpResponsePermanentRedirect(
+			'http://{}/{}{}'.format( site_url.netloc, path_info,
+				'?{}'.format(query_string) if query_string.strip() else '') )
+		return response, None, cachekey
 
 	if response_cache:
-		response = fjcache.cache_get(site.id, cachekey)
+		response = _cached_page(fjcache.cache_get( site.id,
+			cachekey, fjcache.page_namespaces(site.id, **criterias) ))
 		if response: return response, None, cachekey
 
 	return None, site, cachekey
@@ -110,14 +283,17 @@ def redirect(request, url, **kwz):
 	'''Simple redirect, taking site prefix into account,
 		otherwise similar to redirect_to generic view.'''
 	response, site, cachekey = initview(request)
-	if response: return response[0]
+	if response: return cached_response(request, response)
 	return redirect_to(request, url=site.url + url, **kwz)
 
 
+@condition( etag_func=cache_etag,
+	last_modified_func=cache_last_modified )
+@render_lock
 def blogroll(request, btype):
 	'View that handles the generation of blogrolls.'
-	response, site, cachekey = initview(request)
-	if response: return response[0]
+	response, site, cachekey = initview(request, response_lock=True)
+	if response: return cached_response(request, response)
 
 	template = loader.get_template('feedjack/{0}.xml'.format(btype))
 	ctx = dict()
@@ -127,8 +303,9 @@ def blogroll(request, btype):
 		template.render(ctx), mimetype='text/xml; charset=utf-8' )
 
 	patch_vary_headers(response, ['Host'])
-	fjcache.cache_set(
-		site, cachekey, (response, ctx['last_modified']) )
+	fjcache.cache_set( site, cachekey,
+		cache_page(response, page_version(request)),
+		fjcache.page_namespaces(site.id), unlock=lock_owned(request) )
 	return response
 
 
@@ -142,13 +319,86 @@ def opml(request):
 	return blogroll(request, 'opml')
 
 
+# Streamed responses get consumed by any middleware that accesses their content
+#  (e.g. CommonMiddleware with USE_ETAGS, GZip or ConditionalGet), hence the default.
+feed_streaming = getattr( settings, 'FEEDJACK_FEED_STREAMING',
+	not getattr(settings, 'USE_ETAGS', False)
+		and not set(getattr(settings, 'MIDDLEWARE_CLASSES', list())).intersection([
+			'django.middleware.gzip.GZipMiddleware',
+			'django.middleware.http.ConditionalGetMiddleware' ]) )
+
+def feed_markup(feed):
+	'Returns element name for items of a syndication feed and closing tags after these.'
+	if isinstance(feed, feedgenerator.Atom1Feed): return u'entry', u'</feed>'
+	elif isinstance(feed, feedgenerator.RssFeed): return u'item', u'</channel></rss>'
+	raise TypeError('Unsupported syndication feed type: {0!r}'.format(feed))
+
+def feed_item(feed, item, encoding='utf-8'):
+	'Renders an item (dict of keywords for feed.add_item) for a syndication feed.'
+	item_tag = feed_markup(feed)[0]
+	feed.add_item(**item)
+	item, buff = feed.items.pop(), StringIO()
+	handler = SimplerXMLGenerator(buff, encoding)
+	handler.startElement(item_tag, feed.item_attributes(item))
+	feed.add_item_elements(handler, item)
+	handler.endElement(item_tag)
+	return buff.getvalue()
+
+def feed_post_item(post):
+	'Keywords for feed.add_item to represent a post.'
+	return dict(
+		title = u'{0}: {1}'.format(post.feed.name, post.title),
+		link = post.link,
+		description = post.content_safe,
+		author_email = post.author_email,
+		author_name = post.author,
+		pubdate = post.date_modified,
+		unique_id = post.link,
+		categories = [tag.name for tag in post.qtags] )
+
+def feed_fragments(feed, posts, encoding='utf-8'):
+	'''Generator of rendered syndication feed items for posts, reusing ones from cache
+			and storing newly-rendered ones there, so that feeds for any site and
+			criterias (feed, tag, etc) can be assembled from same fragments.
+		Post is re-rendered whenever it (or its tags) gets updated or source feed gets renamed.
+		Tags (qtags) are only prefetched for posts that have to be rendered.'''
+	keys = list( u'{0}.{1}.{2}.{3}'.format( type(feed).__name__,
+		post.id, post.date_updated.isoformat(), post.feed.name ) for post in posts )
+	cached = fjcache.fragments_get(keys)
+	fjlib.posts_prefetch(list( post for key, post
+		in it.izip(keys, posts) if key not in cached ))
+	for key, post in it.izip(keys, posts):
+		try: fragment = cached[key]
+		except KeyError:
+			fragment = feed_item(feed, feed_post_item(post), encoding)
+			fjcache.fragment_set(key, fragment)
+		yield fragment
+
+def feed_stream(feed, fragments, latest_date=None, encoding='utf-8'):
+	'''Generator of a syndication feed document, yielding header first,
+			then every rendered item (see feed_item) as soon as it's available, then closing tags.
+		Items can be produced lazily, so latest_date should be passed for
+			the feed header, if it's known.'''
+	item_tag, footer = feed_markup(feed)
+	footer = footer.encode(encoding)
+	if latest_date: feed.latest_post_date = lambda: latest_date
+	buff = StringIO()
+	feed.write(buff, encoding) # without any items
+	header = buff.getvalue()
+	if not header.endswith(footer):
+		raise ValueError('Unexpected syndication feed closing tags: {0!r}'.format(header[-50:]))
+	yield header[:-len(footer)]
+	for fragment in fragments: yield fragment
+	yield footer
+
 @condition( etag_func=cache_etag,
 	last_modified_func=cache_last_modified )
+@render_lock
 def buildfeed(request, feedclass, **criterias):
 	'View that handles the feeds.'
 	# TODO: quite a mess, can't it be handled with a default feed-vews?
-	response, site, cachekey = initview(request)
-	if response: return response[0]
+	response, site, cachekey = initview(request, response_lock=True, **criterias)
+	if response: return cached_response(request, response)
 
 	feed_title = site.title
 	if criterias.get('feed_id'):
@@ -156,32 +406,21 @@ def buildfeed(request, feedclass, **criterias):
 			feed_title = u'{0} - {1}'.format(
 				models.Feed.objects.get(id=criterias['feed_id']).title, feed_title )
 		except ObjectDoesNotExist: raise Http404 # no such feed
-	object_list = fjlib.get_page(site, page=1, **criterias).object_list
+	object_list = list(fjlib.get_page(site, page=1, **criterias).object_list)
 
 	feed = feedclass( title=feed_title, link=site.url,
 		description=site.description, feed_url=u'{0}/{1}'.format(site.url, '/feed/rss/') )
-	last_modified = datetime(1970, 1, 1)
-	for post in object_list:
-		feed.add_item(
-			title = u'{0}: {1}'.format(post.feed.name, post.title),
-			link = post.link,
-			description = fjlib.html_cleaner(post.content),
-			author_email = post.author_email,
-			author_name = post.author,
-			pubdate = post.date_modified,
-			unique_id = post.link,
-			categories = [tag.name for tag in post.tags.all()] )
-		if post.date_updated > last_modified: last_modified = post.date_updated
-
-	response = HttpResponse(mimetype=feed.mime_type)
+	stream = feed_stream( feed, feed_fragments(feed, object_list),
+		latest_date=max(it.imap(op.attrgetter('date_modified'), object_list)) if object_list else None )
+
+	stream = CacheStream( stream, site, cachekey,
+		fjcache.page_namespaces(site.id, **criterias),
+		feed.mime_type, page_version(request, **criterias), unlock=lock_owned(request) )
+	if not feed_streaming: stream = ''.join(stream)
+	response = HttpResponse(stream, mimetype=feed.mime_type)
 
 	# Per-host caching
 	patch_vary_headers(response, ['Host'])
-
-	feed.write(response, 'utf-8')
-	if site.use_internal_cache:
-		fjcache.cache_set(
-			site, cachekey, (response, last_modified) )
 	return response
 
 
@@ -244,9 +483,10 @@ def ajax_store(request):
 
 @condition( etag_func=cache_etag,
 	last_modified_func=cache_last_modified )
+@render_lock
 def mainview(request, **criterias):
 	'View that handles all page requests.'
-	response, site, cachekey = initview(request)
+	response, site, cachekey = initview(request, response_lock=True, **criterias)
 
 	if not response:
 		ctx = fjlib.page_context(request, site, **criterias)
@@ -256,9 +496,9 @@ def mainview(request, **criterias):
 		# per host caching, in case the cache middleware is enabled
 		patch_vary_headers(response, ['Host'])
 		if site.use_internal_cache:
-			fjcache.cache_set(
-				site, cachekey, (response, ctx['last_modified']) )
-	else: response = response[0]
+			fjcache.cache_set( site, cachekey, cache_page(response, page_version(request, **criterias)),
+				fjcache.page_namespaces(site.id, **criterias), unlock=lock_owned(request) )
+	else: response = cached_response(request, response)
 
 	fj_track_header = request.META.get('HTTP_X_FEEDJACK_TRACKING')\
 		or request.COOKIES.get('feedjack.tracking')